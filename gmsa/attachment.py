@@ -1,19 +1,27 @@
-import base64
 import os
 from typing import Optional
 
+try:
+    from pybase64 import urlsafe_b64decode
+except ImportError:
+    from base64 import urlsafe_b64decode
+
 from googleapiclient import discovery
 
 
 from gmsa.exceptions import AttachmentSaveError
 
+# Number of base64 characters decoded at a time by save_streaming (a multiple of 4)
+_DECODE_CHUNK_SIZE = 4 * 2**18
+
 
 class Attachment:
     '''
     The Attachment class for attachments to emails in your Gmail mailbox.
     '''
     def __init__(self, service: discovery.Resource, user_id: str, msg_id: str,
-                 att_id: str, filename: str, filetype: str, data: Optional[bytes]=None):
+                 att_id: str, filename: str, filetype: str, data: Optional[bytes]=None,
+                 size: Optional[int]=None):
         '''
         Args:
             service: The Gmail service object.
@@ -23,6 +31,7 @@ class Attachment:
             filename: The filename associated with the attachment.
             filetype: The mime type of the file.
             data: The raw data of the file. Default None.
+            size: The size of the file in bytes, if known. Default None.
         '''
         self.service = service
         self.user_id = user_id
@@ -31,6 +40,7 @@ class Attachment:
         self.filename = filename
         self.filetype = filetype
         self.data = data
+        self.size = size
 
 
     def download(self):
@@ -40,12 +50,15 @@ class Attachment:
         if self.data is not None:
             return
 
+        self.data = urlsafe_b64decode(self._fetch_encoded_data())
+
+    def _fetch_encoded_data(self) -> str:
+        'Retrieves the base64url encoded data for the attachment.'
         res = self.service.users().messages().attachments().get(
             userId=self.user_id, messageId=self.msg_id, id=self.id
         ).execute()
 
-        data = res['data']
-        self.data = base64.urlsafe_b64decode(data)
+        return res['data']
 
     def save(self, filepath: Optional[str]=None, overwrite: bool=False):
         '''
@@ -72,3 +85,43 @@ class Attachment:
                 f.write(self.data)
         except (FileNotFoundError, PermissionError, OSError, IOError) as e:
             raise AttachmentSaveError(str(e)) from e
+
+    def save_streaming(self, filepath: Optional[str]=None, overwrite: bool=False,
+                       keep_in_memory: bool=False):
+        '''
+        Saves the attachment. Unlike save(), file data that has not been
+        downloaded yet is decoded to disk in chunks, so the whole decoded file
+        is never held in memory.
+
+        Args:
+            filepath: where to save the attachment. Default uses the filename stored.
+            overwrite: whether to overwrite existing files. Default False.
+            keep_in_memory: whether to keep the file data on the attachment after
+                saving. Default False.
+        '''
+        if keep_in_memory:
+            self.save(filepath, overwrite)
+            return
+
+        if filepath is None:
+            filepath = self.filename
+
+        if not overwrite and os.path.exists(filepath):
+            raise FileExistsError(
+                f'Cannot overwrite file "{filepath}". Use overwrite=True if '
+                'you would like to overwrite the file.'
+            )
+
+        data = self._fetch_encoded_data() if self.data is None else None
+
+        try:
+            with open(filepath, 'wb') as f:
+                if data is None:
+                    f.write(self.data)
+                else:
+                    for start in range(0, len(data), _DECODE_CHUNK_SIZE):
+                        f.write(urlsafe_b64decode(data[start:start + _DECODE_CHUNK_SIZE]))
+        except (FileNotFoundError, PermissionError, OSError, IOError) as e:
+            raise AttachmentSaveError(str(e)) from e
+
+        self.data = None
@@ -1,13 +1,49 @@
+import functools
 import pickle
 import os.path
 import glob
+import socket
 from typing import List, Optional
 
 from googleapiclient import discovery
+from googleapiclient.http import build_http
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.model import JsonModel
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+@functools.lru_cache(maxsize=None)
+def _discovery_doc() -> Optional[str]:
+    """The Gmail discovery document bundled with googleapiclient, read from disk once per process"""
+    return get_static_doc('gmail', 'v1')
+
+
+# Seconds to wait on a socket before giving up on a request, unless a default
+# timeout was set with socket.setdefaulttimeout
+_HTTP_TIMEOUT = 30
+
+
+class _OrjsonModel(JsonModel):
+    """Parses JSON responses with orjson, which is several times faster than the stdlib `json`"""
+
+    def deserialize(self, content):
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # Let `JsonModel` deal with responses that are not JSON
+            return super().deserialize(content)
+
+        if self._data_wrapper and 'data' in body:
+            body = body['data']
+        return body
+
 
 class AuthenticatedService:
     """Handles authentication of the `GoogleCalendar`"""
@@ -79,7 +115,31 @@ class AuthenticatedService:
                 authentication_flow_port
             )
 
-        self.service = discovery.build('gmail', 'v1', credentials=self.credentials)
+        self.service = self._build_service(self.credentials)
+
+    @staticmethod
+    def _build_service(
+            credentials: Credentials
+    ) -> discovery.Resource:
+        model = _OrjsonModel() if orjson is not None else None
+        # All calls of the service (and of the messages built from it) go
+        # through the one authorized connection
+        http = AuthenticatedService._build_http(credentials)
+        doc = _discovery_doc()
+        if doc is None:
+            return discovery.build('gmail', 'v1', http=http, model=model, cache_discovery=False)
+        return discovery.build_from_document(doc, http=http, model=model)
+
+    @staticmethod
+    def _build_http(
+            credentials: Credentials
+    ) -> AuthorizedHttp:
+        # build_http keeps googleapiclient's connection setup (e.g. 308 is not
+        # followed as a redirect) and honours socket.setdefaulttimeout
+        http = build_http()
+        if socket.getdefaulttimeout() is None:
+            http.timeout = _HTTP_TIMEOUT
+        return AuthorizedHttp(credentials, http=http)
 
     @staticmethod
     def _ensure_refreshed(
@@ -1,29 +1,44 @@
-import base64
-import datetime
-from email.mime.audio import MIMEAudio
-from email.mime.application import MIMEApplication
+from email.generator import BytesGenerator
 from email.mime.base import MIMEBase
-from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import html
 import email.utils
-import math
-import mimetypes
 import os
 import re
-import threading
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, List, Optional
 
-from bs4 import BeautifulSoup
 from google.oauth2.credentials import Credentials
 
 from gmsa.authentication import AuthenticatedService
 from gmsa.attachment import Attachment
 from gmsa.label import Label
-from gmsa.message import Message
+from gmsa.message import _MAX_BATCH_SIZE, Message, _clear_label_ids, _execute_with_backoff, _thread_http
+from gmsa.mime import (
+    _HDR_HANDLERS, _LEAF_HANDLERS, _PARSED_LEAF_HANDLERS, _SNIFF_SIZE, _CIHeaderDict, _guess_content_type, _map_file
+)
 from gmsa.utils import extract_and_format_to_header
 
+try:
+    from pybase64 import encodebytes, urlsafe_b64decode, urlsafe_b64encode
+except ImportError:
+    from base64 import encodebytes, urlsafe_b64decode, urlsafe_b64encode
+
+# Maximum number of messages the Gmail API returns per page of a list request
+_MAX_LIST_PAGE_SIZE = 500
+
+# The parts of a message resource that Message objects are built from
+_MESSAGE_FIELDS = 'id,threadId,labelIds,snippet,payload(mimeType,filename,headers,body,parts)'
+
+# Maximum total size of the attachments downloaded in a single batch request, in bytes
+_MAX_BATCH_DOWNLOAD_SIZE = 10 * 2**20
+
+# Extracts the address from a sender of the form "Name <user@example.com>"
+_SENDER_ADDR_RE = re.compile(r'.+\s<(?P<addr>[^<>@\s]+@[^<>@\s]+\.[^<>@\s]+)>')
+
+
 class Gmail(AuthenticatedService):
     '''
     The Gmail class which serves as the entrypoint for the Gmail service API.
@@ -64,6 +79,9 @@ class Gmail(AuthenticatedService):
             authentication_flow_host=authentication_flow_host,
             authentication_flow_port=authentication_flow_port,
         )
+        # Each user's labels keyed by label id, label ids belong to one user
+        self._label_cache: Dict[str, Dict[str, Label]] = {}
+        self._executor = ThreadPoolExecutor(max_workers=24)  # empirically chosen, prevents throttling
 
 
     def send_message(self, sender: str, to: str, subject: str='', msg_html: Optional[str]=None,
@@ -98,7 +116,8 @@ class Gmail(AuthenticatedService):
 
 
     def get_messages(self, user_id: str='me', labels: Optional[List[Label]]=None, query: str='',
-                     attachments: str='reference', include_spam_trash: bool=False) -> List[Message]:
+                     attachments: str='reference', include_spam_trash: bool=False,
+                     parse_html: bool=False, limit: Optional[int]=None) -> List[Message]:
         '''
         Gets messages from your account.
 
@@ -111,6 +130,10 @@ class Gmail(AuthenticatedService):
                 and 'download' which downloads the attachment data to store locally.
                 Default 'reference'.
             include_spam_trash: whether to include messages from spam or trash.
+            parse_html: whether to parse HTML parts and keep only their body element.
+                Default False, which returns the HTML exactly as it was sent.
+            limit: the maximum number of messages to get, newest first. Default None, which
+                gets all matching messages.
         Returns:
             A list of message objects.
         '''
@@ -119,30 +142,31 @@ class Gmail(AuthenticatedService):
 
         labels_ids = [lbl.id if isinstance(lbl, Label) else lbl for lbl in labels]
 
-        response = self.service.users().messages().list(
-            userId=user_id,
-            q=query,
-            labelIds=labels_ids,
-            includeSpamTrash=include_spam_trash
-        ).execute()
+        message_refs: List[dict] = []
+        page_token = None
+        while limit is None or len(message_refs) < limit:
+            page_size = _MAX_LIST_PAGE_SIZE
+            if limit is not None:
+                page_size = min(page_size, limit - len(message_refs))
 
-        message_refs = []
-        if 'messages' in response:  # ensure request was successful
-            message_refs.extend(response['messages'])
-
-        while 'nextPageToken' in response:
-            page_token = response['nextPageToken']
             response = self.service.users().messages().list(
                 userId=user_id,
                 q=query,
                 labelIds=labels_ids,
                 includeSpamTrash=include_spam_trash,
-                pageToken=page_token
+                maxResults=page_size,
+                pageToken=page_token,
+                fields='messages(id,threadId),nextPageToken'
             ).execute()
 
-            message_refs.extend(response['messages'])
+            if 'messages' in response:  # ensure request was successful
+                message_refs.extend(response['messages'])
+
+            page_token = response.get('nextPageToken')
+            if page_token is None:
+                break
 
-        return self._get_messages_from_refs(user_id, message_refs, attachments)
+        return self._get_messages_from_refs(user_id, message_refs, attachments, parse_html=parse_html)
 
 
     def list_labels(self, user_id: str='me') -> List[Label]:
@@ -174,6 +198,7 @@ class Gmail(AuthenticatedService):
             The created Label object.
         '''
         res = self.service.users().labels().create(userId=user_id, body={'name': name}).execute()
+        self._label_cache.pop(user_id, None)
         return Label(res['name'], res['id'])
 
     def delete_label(self, label_: Label, user_id: str = 'me'):
@@ -185,10 +210,35 @@ class Gmail(AuthenticatedService):
             user_id: The user's email address. By default, the authenticated user.
         '''
         self.service.users().labels().delete(userId=user_id, id=label_.id).execute()
+        self._label_cache.pop(user_id, None)
+        _clear_label_ids(self.service)
+
+    def _get_label_map(self, user_id: str='me', refresh: bool=False) -> Dict[str, Label]:
+        '''
+        Returns the user's labels keyed by label id. The labels are fetched
+        once per user and cached on the instance until a label of that user
+        is created or deleted.
+        Refreshing updates the cached dict in place, so maps handed out
+        earlier see the new labels too.
+
+        Args:
+            user_id: The user's email address. By default, the authenticated user.
+            refresh: Whether to refetch the labels even if they are cached.
+        Returns:
+            A dict of label id to Label object.
+        '''
+        labels = self._label_cache.get(user_id)
+        if labels is None:
+            labels = self._label_cache[user_id] = {x.id: x for x in self.list_labels(user_id=user_id)}
+        elif refresh:
+            labels.update((x.id, x) for x in self.list_labels(user_id=user_id))
+        return labels
 
 
     def _get_messages_from_refs(self, user_id: str, message_refs: List[dict],
-                                attachments: str='reference', parallel: bool=True) -> List[Message]:
+                                attachments: str='reference', parallel: bool=True,
+                                parse_html: bool=False,
+                                label_map: Optional[Dict[str, Label]]=None) -> List[Message]:
         '''
         Retrieves the actual messages from a list of references.
 
@@ -199,52 +249,132 @@ class Gmail(AuthenticatedService):
                 'reference' which includes attachment information but does not download the data,
                 and 'download' which downloads the attachment data to store locally.
                 Default 'reference'.
-            parallel: Whether to retrieve messages in parallel. Default true. Currently
-                parallelization is always on, since there is no reason to do otherwise.
+            parallel: Whether to retrieve messages in parallel, using batch requests of up
+                to 100 messages each. Default true. Currently parallelization is always on,
+                since there is no reason to do otherwise.
+            parse_html: whether to parse HTML parts and keep only their body element.
+                Default False.
+            label_map: The user's labels keyed by label id. Default None, which uses
+                the cached labels.
         Returns:
             A list of Message objects.
         '''
         if not message_refs:
             return []
 
-        if not parallel:
-            return [self._build_message_from_ref(user_id, ref, attachments) for ref in message_refs]
-
-        max_num_threads = 24  # empirically chosen, prevents throttling
-        target_msgs_per_thread = 20  # empirically chosen
-        num_threads = min(
-            math.ceil(len(message_refs) / target_msgs_per_thread),
-            max_num_threads
-        )
-        batch_size = math.ceil(len(message_refs) / num_threads)
-        message_lists = [[] for _ in range(num_threads)]
+        # Fetch the labels once up front rather than once per message
+        if label_map is None:
+            label_map = self._get_label_map(user_id)
 
-        def thread_download_batch(thread_num):
-            gmail = Gmail(credentials=self.credentials)
-
-            start = thread_num * batch_size
-            end = min(len(message_refs), (thread_num + 1) * batch_size)
-            message_lists[thread_num] = [
-                self._build_message_from_ref(user_id, message_refs[i], attachments)
-                for i in range(start, end)
+        if not parallel:
+            return [
+                self._build_message_from_ref(user_id, ref, attachments, parse_html, label_map)
+                for ref in message_refs
             ]
 
-            gmail.service.close()
+        if not hasattr(self.service, 'new_batch_http_request'):
+            messages = self._get_messages_from_refs_threaded(
+                user_id, message_refs, attachments, parse_html, label_map
+            )
+        else:
+            messages = self._get_messages_from_refs_batched(
+                user_id, message_refs, attachments, parse_html, label_map
+            )
 
-        threads = [
-            threading.Thread(target=thread_download_batch, args=(i,))
-            for i in range(num_threads)
-        ]
+        if attachments == 'download':
+            self._batch_download_attachments([attm for msg in messages for attm in msg.attachments])
 
-        for t in threads:
-            t.start()
+        return messages
 
-        for t in threads:
-            t.join()
+    def _get_messages_from_refs_batched(self, user_id: str, message_refs: List[dict],
+                                        attachments: str='reference', parse_html: bool=False,
+                                        label_map: Optional[Dict[str, Label]]=None) -> List[Message]:
+        '''
+        Retrieves the actual messages from a list of references, fetching up
+        to 100 messages per batch request. Messages that fail inside a batch
+        (e.g. rate limited ones) are fetched again on their own, with backoff.
+        Attachment data is not downloaded.
 
-        return sum(message_lists, [])
+        Args:
+            user_id: The account the messages belong to.
+            message_refs: A list of message references with keys id, threadId.
+            attachments: Accepted values are 'ignore' which completely ignores all attachments,
+                'reference' which includes attachment information but does not download the data,
+                and 'download' which downloads the attachment data to store locally.
+                Default 'reference'.
+            parse_html: whether to parse HTML parts and keep only their body element.
+                Default False.
+            label_map: The user's labels keyed by label id. Default None, which uses
+                the cached labels.
+        Returns:
+            A list of Message objects.
+        '''
+        results: List[Optional[Message]] = [None] * len(message_refs)
+        failed: List[int] = []
+
+        def build_request(i: int):
+            return self.service.users().messages().get(
+                userId=user_id, id=message_refs[i]['id'], fields=_MESSAGE_FIELDS
+            )
+
+        def batch_callback(request_id, response, exception):
+            if exception is not None:
+                failed.append(int(request_id))
+            else:
+                results[int(request_id)] = self._build_message_from_payload(
+                    user_id, response, attachments, parse_html, label_map
+                )
+
+        for start in range(0, len(message_refs), _MAX_BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=batch_callback)
+            for i in range(start, min(start + _MAX_BATCH_SIZE, len(message_refs))):
+                batch.add(build_request(i), request_id=str(i))
+            batch.execute()
+
+        for i in failed:
+            response = _execute_with_backoff(build_request(i), self.service, user_id)
+            results[i] = self._build_message_from_payload(
+                user_id, response, attachments, parse_html, label_map
+            )
+
+        return results
+
+    def _get_messages_from_refs_threaded(self, user_id: str, message_refs: List[dict],
+                                         attachments: str='reference', parse_html: bool=False,
+                                         label_map: Optional[Dict[str, Label]]=None) -> List[Message]:
+        '''
+        Retrieves the actual messages from a list of references, issuing one
+        request per message on the instance's thread pool. Used when the
+        service does not support batch requests. Attachment data is not
+        downloaded.
 
-    def _build_message_from_ref(self, user_id: str, message_ref: dict, attachments: str='reference') -> Message:
+        Args:
+            user_id: The account the messages belong to.
+            message_refs: A list of message references with keys id, threadId.
+            attachments: Accepted values are 'ignore' which completely ignores all attachments,
+                'reference' which includes attachment information but does not download the data,
+                and 'download' which downloads the attachment data to store locally.
+                Default 'reference'.
+            parse_html: whether to parse HTML parts and keep only their body element.
+                Default False.
+            label_map: The user's labels keyed by label id. Default None, which uses
+                the cached labels.
+        Returns:
+            A list of Message objects.
+        '''
+        def download(message_ref):
+            # httplib2 is not thread-safe, so the shared service sends the requests of each
+            # worker thread over that thread's own connection
+            message = self.service.users().messages().get(
+                userId=user_id, id=message_ref['id'], fields=_MESSAGE_FIELDS
+            ).execute(http=_thread_http(self.credentials))
+            return self._build_message_from_payload(user_id, message, attachments, parse_html, label_map)
+
+        return list(self._executor.map(download, message_refs))
+
+    def _build_message_from_ref(self, user_id: str, message_ref: dict, attachments: str='reference',
+                                parse_html: bool=False,
+                                label_map: Optional[Dict[str, Label]]=None) -> Message:
         '''
         Creates a Message object from a reference.
 
@@ -255,148 +385,212 @@ class Gmail(AuthenticatedService):
                 'reference' which includes attachment information but does not download the data,
                 and 'download' which downloads the attachment data to store locally.
                 Default 'reference'.
+            parse_html: whether to parse HTML parts and keep only their body element.
+                Default False.
+            label_map: The user's labels keyed by label id. Default None, which uses
+                the cached labels.
         Returns:
             The Message object.
         '''
         # Get message JSON
-        message = self.service.users().messages().get(userId=user_id, id=message_ref['id']).execute()
+        message = self.service.users().messages().get(
+            userId=user_id, id=message_ref['id'], fields=_MESSAGE_FIELDS
+        ).execute()
 
+        msg = self._build_message_from_payload(user_id, message, attachments, parse_html, label_map)
+        if attachments == 'download':
+            self._batch_download_attachments(msg.attachments)
+
+        return msg
+
+    def _build_message_from_payload(self, user_id: str, message: dict, attachments: str='reference',
+                                    parse_html: bool=False,
+                                    label_map: Optional[Dict[str, Label]]=None) -> Message:
+        '''
+        Creates a Message object from a message resource already retrieved
+        from the Gmail API. Only attachment data included in the message
+        itself is set, the rest is left to _batch_download_attachments.
+
+        Args:
+            user_id: The username of the account the message belongs to.
+            message: The message object returned from the Gmail API.
+            attachments: Accepted values are 'ignore' which completely ignores all attachments,
+                'reference' which includes attachment information but does not download the data,
+                and 'download' which downloads the attachment data to store locally.
+                Default 'reference'.
+            parse_html: whether to parse HTML parts and keep only their body element.
+                Default False.
+            label_map: The user's labels keyed by label id. Default None, which uses
+                the cached labels.
+        Returns:
+            The Message object.
+        '''
         msg_id = message['id']
         thread_id = message['threadId']
         label_ids = []
         if 'labelIds' in message:
-            user_labels = {x.id: x for x in self.list_labels(user_id=user_id)}
-            label_ids = [user_labels[x] for x in message['labelIds']]
-        snippet = html.unescape(message['snippet'])
+            if label_map is None:
+                label_map = self._get_label_map(user_id)
+            if any(x not in label_map for x in message['labelIds']):
+                # A label was added since the labels were fetched
+                label_map.update(self._get_label_map(user_id, refresh=True))
+            label_ids = [label_map[x] for x in message['labelIds']]
+        snippet = message['snippet']
+        if '&' in snippet:  # most snippets contain no character references
+            snippet = html.unescape(snippet)
 
         payload = message['payload']
         headers = payload['headers']
 
         # Get header fields (date, from, to, subject)
-        date = ''
-        sender = ''
-        recipient = ''
-        subject = ''
-        msg_hdrs = {}
-        cc = []
-        bcc = []
+        fields = {'date': '', 'sender': '', 'recipient': '', 'subject': '', 'cc': [], 'bcc': []}
+        msg_hdrs = _CIHeaderDict()
         for hdr in headers:
-            if hdr['name'].lower() == 'date':
-                try:
-                    date = str(datetime.datetime.strptime(
-                        hdr['value'], '%d %b %Y %H:%M:%S %z'
-                    ).astimezone())
-                except ValueError:
-                    date = hdr['value']
-            elif hdr['name'].lower() == 'from':
-                sender = hdr['value']
-            elif hdr['name'].lower() == 'to':
-                recipient = hdr['value']
-            elif hdr['name'].lower() == 'subject':
-                subject = hdr['value']
-            elif hdr['name'].lower() == 'cc':
-                cc = hdr['value'].split(', ')
-            elif hdr['name'].lower() == 'bcc':
-                bcc = hdr['value'].split(', ')
-
-            msg_hdrs[hdr['name']] = hdr['value']
-
-        parts = self._evaluate_message_payload(payload, user_id, message_ref['id'], attachments)
-
-        plain_msg=None
-        html_msg=None
+            name = hdr['name']
+            value = hdr['value']
+            lower = name.lower()
+            handler = _HDR_HANDLERS.get(lower)
+            if handler is not None:
+                field, field_value = handler(value)
+                fields[field] = field_value
+
+            msg_hdrs.add_header(name, lower, value)
+
+        parts = self._evaluate_message_payload(payload, attachments, parse_html)
+
+        plain_parts: List[str] = []
+        html_parts: List[str] = []
         attms = []
         for part in parts:
             if part['part_type'] == 'plain':
-                if plain_msg is None:
-                    plain_msg = part['body']
-                else:
-                    plain_msg += '\n' + part['body']
+                plain_parts.append(part['body'])
             elif part['part_type'] == 'html':
-                if html_msg is None:
-                    html_msg = part['body']
-                else:
-                    html_msg += '<br/>' + part['body']
+                html_parts.append(part['body'])
             elif part['part_type'] == 'attachment':
                 attm = Attachment(self.service, user_id, msg_id,
                                   part['attachment_id'], part['filename'],
-                                  part['filetype'], part['data'])
+                                  part['filetype'], part['data'], part['size'])
                 attms.append(attm)
 
+        plain_msg = '\n'.join(plain_parts) if plain_parts else None
+        html_msg = '<br/>'.join(html_parts) if html_parts else None
+
         return Message(
-            self.service, self.credentials, user_id, msg_id, thread_id, recipient, sender, subject,
-            date, snippet, plain_msg, html_msg, label_ids, attms, msg_hdrs, cc, bcc
+            self.service, self.credentials, user_id, msg_id, thread_id, fields['recipient'],
+            fields['sender'], fields['subject'], fields['date'], snippet, plain_msg, html_msg,
+            label_ids, attms, msg_hdrs, fields['cc'], fields['bcc']
         )
 
-    def _evaluate_message_payload(self, payload: dict, user_id: str, msg_id: str,
-                                  attachments: str='reference') -> List[dict]:
+    def _evaluate_message_payload(self, payload: dict, attachments: str='reference',
+                                  parse_html: bool=False) -> List[dict]:
         '''
-        Recursively evaluates a message payload.
+        Evaluates a message payload and all of its nested parts.
 
         Args:
             payload: The message payload object (response from Gmail API).
-            user_id: The current account address (default 'me').
-            msg_id: The id of the message.
             attachments: Accepted values are 'ignore' which completely ignores all attachments,
                 'reference' which includes attachment information but does not download the data,
                 and 'download' which downloads the attachment data to store locally.
                 Default 'reference'.
+            parse_html: whether to parse HTML parts and keep only their body element.
+                Default False.
         Returns:
             A list of message parts.
         '''
-        if 'attachmentId' in payload['body']:  # if it's an attachment
-            if attachments == 'ignore':
-                return []
-
-            att_id = payload['body']['attachmentId']
-            filename = payload['filename']
-            if not filename:
-                filename = 'unknown'
-
-            obj = {
-                'part_type': 'attachment',
-                'filetype': payload['mimeType'],
-                'filename': filename,
-                'attachment_id': att_id,
-                'data': None
-            }
-
-            if attachments == 'reference':
-                return [obj]
+        leaf_handlers = _PARSED_LEAF_HANDLERS if parse_html else _LEAF_HANDLERS
+
+        ret = []
+        stack = [payload]
+        while stack:
+            part = stack.pop()
+            body = part['body']
+            mime_type = part['mimeType']
+
+            if 'attachmentId' in body:  # if it's an attachment
+                if attachments == 'ignore':
+                    continue
+
+                # Small attachments come inline with the payload and need no
+                # request. The rest are downloaded afterwards by
+                # _batch_download_attachments
+                inline = body.get('data')
+                data = None
+                if inline is not None and attachments == 'download':
+                    data = urlsafe_b64decode(inline)
+
+                ret.append({
+                    'part_type': 'attachment',
+                    'filetype': mime_type,
+                    'filename': part['filename'] or 'unknown',
+                    'attachment_id': body['attachmentId'],
+                    'size': body.get('size'),
+                    'data': data
+                })
+                continue
+
+            handler = leaf_handlers.get(mime_type)
+            if handler is not None:
+                ret.append(handler(body['data']))
+            elif 'parts' in part and mime_type.startswith('multipart'):
+                # Pushed in reverse so that parts are evaluated in their original order
+                stack.extend(reversed(part['parts']))
+
+        return ret
+
+    def _batch_download_attachments(self, attms: List[Attachment]):
+        '''
+        Downloads the data of the given attachments that have not been
+        downloaded yet, fetching up to 100 attachments (and at most 10 MiB)
+        per batch request. Attachments that fail inside a batch are fetched
+        again on their own, with backoff.
 
-            else:  # attachments == 'download'
-                if 'data' in payload['body']:
-                    data = payload['body']['data']
-                else:
-                    res = self.service.users().messages().attachments().get(
-                        userId=user_id, messageId=msg_id, id=att_id
-                    ).execute()
-                    data = res['data']
-
-                file_data = base64.urlsafe_b64decode(data)
-                obj['data'] = file_data
-                return [obj]
-
-        elif payload['mimeType'] == 'text/html':
-            data = payload['body']['data']
-            data = base64.urlsafe_b64decode(data)
-            body = BeautifulSoup(data, 'lxml', from_encoding='utf-8').body
-            return [{ 'part_type': 'html', 'body': str(body) }]
-
-        elif payload['mimeType'] == 'text/plain':
-            data = payload['body']['data']
-            data = base64.urlsafe_b64decode(data)
-            body = data.decode('UTF-8')
-            return [{ 'part_type': 'plain', 'body': body }]
-
-        elif payload['mimeType'].startswith('multipart'):
-            ret = []
-            if 'parts' in payload:
-                for part in payload['parts']:
-                    ret.extend(self._evaluate_message_payload(part, user_id, msg_id, attachments))
-            return ret
-
-        return []
+        Args:
+            attms: The attachments to download, possibly from several messages.
+        '''
+        attms = [attm for attm in attms if attm.data is None]
+        if not attms:
+            return
+
+        if not hasattr(self.service, 'new_batch_http_request'):
+            for attm in attms:
+                attm.download()
+            return
+
+        failed: List[int] = []
+
+        def build_request(attm: Attachment):
+            return self.service.users().messages().attachments().get(
+                userId=attm.user_id, messageId=attm.msg_id, id=attm.id
+            )
+
+        def batch_callback(request_id, response, exception):
+            if exception is not None:
+                failed.append(int(request_id))
+            else:
+                attms[int(request_id)].data = urlsafe_b64decode(response['data'])
+
+        batch = self.service.new_batch_http_request(callback=batch_callback)
+        batch_len = 0
+        batch_size = 0
+        for i, attm in enumerate(attms):
+            attm_size = attm.size or 0
+            if batch_len and (batch_len == _MAX_BATCH_SIZE
+                              or batch_size + attm_size > _MAX_BATCH_DOWNLOAD_SIZE):
+                batch.execute()
+                batch = self.service.new_batch_http_request(callback=batch_callback)
+                batch_len = 0
+                batch_size = 0
+
+            batch.add(build_request(attm), request_id=str(i))
+            batch_len += 1
+            batch_size += attm_size
+
+        batch.execute()
+
+        for i in failed:
+            attm = attms[i]
+            response = _execute_with_backoff(build_request(attm), self.service, attm.user_id)
+            attm.data = urlsafe_b64decode(response['data'])
 
     def _create_message(
         self,
@@ -460,7 +654,7 @@ class Gmail(AuthenticatedService):
             msg['References'] = references
 
         if signature:
-            m = re.match(r'.+\s<(?P<addr>.+@.+\..+)>', sender)
+            m = _SENDER_ADDR_RE.match(sender)
             address = m.group('addr') if m else sender
             account_sig = self._get_alias_info(address, user_id)['signature']
 
@@ -485,7 +679,11 @@ class Gmail(AuthenticatedService):
             msg.attach(alternative_part)
 
         result = {}
-        result['raw'] = base64.urlsafe_b64encode(msg.as_string().encode('utf-8')).decode('utf-8')
+        # Flattened straight to bytes (as as_string() would, without folding headers), skipping
+        # the intermediate str. The base64url output is pure ASCII.
+        raw = BytesIO()
+        BytesGenerator(raw, mangle_from_=False, maxheaderlen=0).flatten(msg)
+        result['raw'] = urlsafe_b64encode(raw.getbuffer()).decode('ascii')
         if thread_id:
             result['threadId'] = thread_id
 
@@ -500,27 +698,18 @@ class Gmail(AuthenticatedService):
             attachments: A list of attachment file paths.
         '''
         for filepath in attachments:
-            content_type, encoding = mimetypes.guess_type(filepath)
-
-            if content_type is None or encoding is not None:
-                content_type = 'application/octet-stream'
-
-            main_type, sub_type = content_type.split('/', 1)
-            with open(filepath, 'rb') as file:
-                raw_data = file.read()
+            with _map_file(filepath) as raw_data:
+                content_type = _guess_content_type(filepath, raw_data[:_SNIFF_SIZE])
+                main_type, sub_type = content_type.split('/', 1)
 
                 attm: MIMEBase
                 if main_type == 'text':
-                    attm = MIMEText(raw_data.decode('UTF-8'), _subtype=sub_type)
-                elif main_type == 'image':
-                    attm = MIMEImage(raw_data, _subtype=sub_type)
-                elif main_type == 'audio':
-                    attm = MIMEAudio(raw_data, _subtype=sub_type)
-                elif main_type == 'application':
-                    attm = MIMEApplication(raw_data, _subtype=sub_type)
+                    attm = MIMEText(str(raw_data, 'UTF-8'), _subtype=sub_type)
                 else:
+                    # Same result as MIMEImage/MIMEAudio/MIMEApplication, encoded with our base64 codec
                     attm = MIMEBase(main_type, sub_type)
-                    attm.set_payload(raw_data)
+                    attm.set_payload(encodebytes(raw_data).decode('ascii'))
+                    attm['Content-Transfer-Encoding'] = 'base64'
 
             fname = os.path.basename(filepath)
             attm.add_header('Content-Disposition', 'attachment', filename=fname)
@@ -567,7 +756,8 @@ class Gmail(AuthenticatedService):
         self,
         thread_id: str,
         user_id: str = 'me',
-        attachments: str = 'reference'
+        attachments: str = 'reference',
+        parse_html: bool = False
     ) -> List[Message]:
         """
         Gets all messages with the specified thread_id.
@@ -578,6 +768,8 @@ class Gmail(AuthenticatedService):
             attachments: Accepted values are 'ignore' which completely ignores all attachments,
                          'reference' which includes attachment information but does not download the data,
                          and 'download' which downloads the attachment data to store locally. Default 'reference'.
+            parse_html: Whether to parse HTML parts and keep only their body element. Default False,
+                        which returns the HTML exactly as it was sent.
 
         Returns:
             A list of Message objects.
@@ -586,14 +778,16 @@ class Gmail(AuthenticatedService):
             googleapiclient.errors.HttpError: There was an error executing the HTTP request.
         """
 
+        # Only the references are needed, the messages are fetched below
         response = self.service.users().threads().get(
             userId=user_id,
-            id=thread_id
+            id=thread_id,
+            fields='messages(id,threadId)'
         ).execute()
 
         message_refs = response.get('messages', [])
 
-        return self._get_messages_from_refs(user_id, message_refs, attachments)
+        return self._get_messages_from_refs(user_id, message_refs, attachments, parse_html=parse_html)
 
     def reply_message(
         self,
@@ -1,14 +1,414 @@
-from typing import List, Optional, Union
+import asyncio
+import random
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import quote
 
 from googleapiclient import discovery
+from googleapiclient.errors import HttpError
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 
 from gmsa import label
 from gmsa.attachment import Attachment
+from gmsa.authentication import AuthenticatedService
 from gmsa.label import Label
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
-class Message:
+
+# The types of a single label argument, as opposed to a list of labels
+_SCALAR_LABEL = (Label, str)
+
+# The maximum number of calls the Gmail API accepts in one batch request
+_MAX_BATCH_SIZE = 100
+
+# The maximum number of message ids one batchModify call accepts
+_MAX_BATCH_MODIFY_SIZE = 1000
+
+# Statuses worth retrying: rate limits and transient server errors
+_RETRY_STATUSES = (429, 500, 503)
+
+# Gmail allows each user 250 quota units per second
+_USER_QUOTA_RATE = 250
+
+# The quota units each method costs, anything else costs 5
+_QUOTA_UNITS = {
+    'gmail.users.labels.list': 1,
+    'gmail.users.messages.batchModify': 50,
+}
+
+
+class _RateLimiter:
+    '''
+    A token bucket holding up to `rate` quota units, refilled at `rate` units
+    per second. Callers wait until the bucket is full enough for their
+    request instead of running into 429 responses.
+    '''
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, units: float):
+        'Waits until the given units are available and takes them.'
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                # A batch may cost more than the bucket holds, it then waits
+                # for a full bucket and leaves the bucket in debt
+                needed = min(units, self.rate)
+                if self._tokens >= needed:
+                    self._tokens -= units
+                    return
+                time.sleep((needed - self._tokens) / self.rate)
+
+
+# Rate limiters by user id for each service, the quota belongs to an account
+_rate_limiters: 'weakref.WeakKeyDictionary[discovery.Resource, Dict[str, _RateLimiter]]' = \
+    weakref.WeakKeyDictionary()
+_rate_limiters_lock = threading.Lock()
+
+# The HTTP connection of each worker thread (of parallel_apply, or of the message
+# fetch fallback in Gmail) and the credentials it was built for. httplib2 is not
+# thread-safe, so workers do not share the service's connection
+_thread_local = threading.local()
+
+
+def _thread_http(credentials: Credentials):
+    'Returns the current thread\'s connection for the given credentials, building it on first use.'
+    http = getattr(_thread_local, 'http', None)
+    if http is None or getattr(_thread_local, 'creds', None) is not credentials:
+        http = _thread_local.http = AuthenticatedService._build_http(credentials)
+        _thread_local.creds = credentials
+    return http
+
+
+def _execute(request: discovery.HttpRequest) -> dict:
+    'Executes a request over the current thread\'s connection, if it has its own.'
+    http = getattr(_thread_local, 'http', None)
+    if http is None:
+        return request.execute()
+    return request.execute(http=http)
+
+
+def _execute_with_backoff(request: discovery.HttpRequest, service: discovery.Resource, user_id: str,
+                          tries: int=6, units: Optional[int]=None) -> dict:
+    '''
+    Executes a request within the user's quota, retrying with exponential
+    backoff when it is rate limited or fails with a transient server error.
+
+    Args:
+        request: The request to execute.
+        service: The service the request was built from.
+        user_id: The user the request is made for.
+        tries: How many times to try the request. Default 6.
+        units: The quota units the request costs. Default None, which looks
+            them up by the request's method.
+    Returns:
+        The decoded response.
+    Raises:
+        googleapiclient.errors.HttpError: The request failed for good.
+    '''
+    with _rate_limiters_lock:
+        limiters = _rate_limiters.get(service)
+        if limiters is None:
+            limiters = _rate_limiters[service] = {}
+        limiter = limiters.get(user_id)
+        if limiter is None:
+            limiter = limiters[user_id] = _RateLimiter(_USER_QUOTA_RATE)
+    if units is None:
+        units = _QUOTA_UNITS.get(getattr(request, 'methodId', None), 5)
+
+    for i in range(tries):
+        limiter.acquire(units)
+        try:
+            return _execute(request)
+        except HttpError as e:
+            if e.resp.status not in _RETRY_STATUSES or i == tries - 1:
+                raise
+            time.sleep(min(2**i + random.random(), 32))
+
+
+# The messages collection of each service. Discovery builds a new resource
+# object on every users().messages() call otherwise
+_messages_resources: 'weakref.WeakKeyDictionary[discovery.Resource, discovery.Resource]' = \
+    weakref.WeakKeyDictionary()
+
+
+def _messages_api(service: discovery.Resource) -> discovery.Resource:
+    'Returns the users().messages() collection of the given service.'
+    try:
+        return _messages_resources[service]
+    except KeyError:
+        api = _messages_resources[service] = service.users().messages()
+        return api
+
+
+def _group_by_account(messages: List['Message']) -> List[List['Message']]:
+    '''
+    Groups messages by service and account, since batch requests and label
+    ids belong to one account.
+
+    Args:
+        messages: The messages, possibly from several accounts.
+    Returns:
+        The groups of messages, in the order their accounts first appear.
+    '''
+    groups: Dict[Tuple[int, str], List[Message]] = {}
+    for msg in messages:
+        groups.setdefault((id(msg.service), msg.user_id), []).append(msg)
+    return list(groups.values())
+
+
+def _label_ids_callback(chunk: List['Message'], failed: List['Message']) -> Callable:
+    '''
+    Builds the callback of a batch of calls that return label ids, one per
+    message of the chunk.
+
+    Args:
+        chunk: The messages of the batch, indexed by request id.
+        failed: Collects the messages whose call failed with an HttpError.
+
+    Returns:
+        The batch callback, storing each message's new labels.
+    '''
+    def callback(request_id, response, exception):
+        msg = chunk[int(request_id)]
+        if isinstance(exception, HttpError):
+            failed.append(msg)
+        elif exception is not None:
+            raise exception
+        else:
+            msg.label_ids = response.get('labelIds', [])
+
+    return callback
+
+
+# Label ids by (user id, lowercased label name) for each service, filled
+# from labels.list so that label names are not looked up on every call
+_label_ids_by_name: 'weakref.WeakKeyDictionary[discovery.Resource, Dict[Tuple[str, str], str]]' = \
+    weakref.WeakKeyDictionary()
+# Serializes the label lookups and creations of parallel_apply workers
+_label_ids_lock = threading.Lock()
+
+# The statuses of a modify call that sent a label id that no longer exists
+_STALE_LABEL_STATUSES = (400, 404)
+
+
+def _clear_label_ids(service: discovery.Resource):
+    'Forgets the label ids looked up through the given service, e.g. after a label is deleted.'
+    _label_ids_by_name.pop(service, None)
+
+
+# Base URL of the Gmail REST API, called directly by the async methods
+_GMAIL_API_URL = 'https://gmail.googleapis.com/gmail/v1/users'
+
+# The most requests the async methods have in flight at once
+_MAX_ASYNC_REQUESTS = 10
+
+
+class _AioState:
+    '''
+    The aiohttp session shared by the async methods, the event loop it belongs
+    to, and the loop's locks. Everything is recreated when the methods are
+    used from another event loop.
+    '''
+    def __init__(self):
+        self.session: Optional['aiohttp.ClientSession'] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        # Makes concurrent calls refresh expired credentials only once
+        self.refresh_lock: Optional[asyncio.Lock] = None
+        # Makes concurrent calls look up (and create) label names one at a time
+        self.label_lock: Optional[asyncio.Lock] = None
+        self.semaphore: Optional[asyncio.Semaphore] = None
+
+    async def get_session(self) -> 'aiohttp.ClientSession':
+        'Returns the shared session, creating it on first use in the running event loop.'
+        if aiohttp is None:
+            raise ImportError('The async Message methods require aiohttp: pip install gmsa[async]')
+
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self.loop is not loop:
+            if self.loop is not loop:
+                await self.close()
+            self.session = aiohttp.ClientSession()
+            self.loop = loop
+            self.refresh_lock = asyncio.Lock()
+            self.label_lock = asyncio.Lock()
+            self.semaphore = asyncio.Semaphore(_MAX_ASYNC_REQUESTS)
+        return self.session
+
+    async def close(self):
+        'Closes the session, from the event loop it belongs to if that loop still runs elsewhere.'
+        session, loop = self.session, self.loop
+        self.session = None
+        if session is None or session.closed:
+            return
+
+        if loop is asyncio.get_running_loop():
+            await session.close()
+        elif loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+        else:
+            try:
+                await session.close()
+            except RuntimeError:
+                pass  # its event loop is closed, and with it its connections
+
+
+_aio = _AioState()
+
+
+async def close_async_session():
+    'Closes the aiohttp session shared by the async Message methods, if one was opened.'
+    await _aio.close()
+
+
+class AsyncMessage:
+    '''
+    Async versions of the Message label operations. They call the Gmail REST
+    API directly over a shared aiohttp session instead of going through the
+    blocking googleapiclient service, so many messages can be modified
+    concurrently:
+
+        await asyncio.gather(*(msg.amodify_labels([], label.UNREAD) for msg in messages))
+
+    At most 10 requests are in flight at once, and rate limited or failed
+    requests are retried with backoff. Requires aiohttp (pip install
+    gmsa[async]). Call close_async_session() before the event loop shuts down.
+    '''
+    __slots__ = ()
+
+    async def _arequest(self, method: str, path: str, body: Optional[dict]=None, tries: int=6) -> dict:
+        '''
+        Calls a Gmail API endpoint of this message's user, retrying with
+        exponential backoff when it is rate limited or fails with a transient
+        server error.
+
+        Args:
+            method: The HTTP method.
+            path: The endpoint path, relative to users/{user_id}/.
+            body: The JSON request body. Default None.
+            tries: How many times to try the request. Default 6.
+        Returns:
+            The decoded JSON response.
+        Raises:
+            aiohttp.ClientResponseError: The request failed for good.
+        '''
+        session = await _aio.get_session()
+        url = f'{_GMAIL_API_URL}/{quote(self.user_id)}/{path}'
+
+        attempt = 0
+        while True:
+            if not self.creds.valid:
+                async with _aio.refresh_lock:
+                    if not self.creds.valid:
+                        # Refreshing is a blocking request, keep it off the event loop
+                        await asyncio.get_running_loop().run_in_executor(None, self.creds.refresh, Request())
+
+            headers = {'Authorization': f'Bearer {self.creds.token}'}
+            async with _aio.semaphore:
+                async with session.request(method, url, json=body, headers=headers) as resp:
+                    if resp.status not in _RETRY_STATUSES or attempt == tries - 1:
+                        resp.raise_for_status()
+                        return await resp.json()
+            await asyncio.sleep(min(2**attempt + random.random(), 32))
+            attempt += 1
+
+    async def atrash(self):
+        'Moves this message to the trash. Async version of trash.'
+        res = await self._arequest('POST', f'messages/{self.id}/trash?fields=labelIds')
+        applied = res.get('labelIds', [])
+
+        assert label.TRASH.id in applied, 'An error occurred in a call to `atrash`.'
+
+        self._set_label_ids(applied)
+
+    async def auntrash(self):
+        'Removes this message from the trash. Async version of untrash.'
+        res = await self._arequest('POST', f'messages/{self.id}/untrash?fields=labelIds')
+        applied = res.get('labelIds', [])
+
+        assert label.TRASH.id not in applied, 'An error occurred in a call to `auntrash`.'
+
+        self._set_label_ids(applied)
+
+    async def _aget_or_create_label_id(self, label_name: str) -> str:
+        '''
+        Gets the label ID for the given label name, creating the label if it
+        does not exist. Shares the label id cache of _get_or_create_label_id,
+        and looks names up one at a time so that concurrent calls do not
+        create the same label twice.
+        '''
+        await _aio.get_session()
+        async with _aio.label_lock:
+            ids = _label_ids_by_name.get(self.service)
+            if ids is None:
+                ids = _label_ids_by_name.setdefault(self.service, {})
+
+            key = (self.user_id, label_name.lower())
+            if key not in ids:
+                labels = (await self._arequest('GET', 'labels?fields=labels(id,name)')).get('labels', [])
+                ids.update(((self.user_id, lbl['name'].lower()), lbl['id']) for lbl in labels)
+            if key in ids:
+                return ids[key]
+
+            created_label = await self._arequest('POST', 'labels?fields=id', {
+                'name': label_name,
+                'labelListVisibility': 'labelShow',
+                'messageListVisibility': 'show'
+            })
+            ids[key] = created_label['id']
+            return created_label['id']
+
+    async def amodify_labels(self, to_add: Union[Label, str, List[Label], List[str]],
+                             to_remove: Union[Label, str, List[Label], List[str]]):
+        '''
+        Adds or removes the specified labels. Async version of modify_labels.
+
+        Args:
+            to_add: The label or list of labels to add.
+            to_remove: The label or list of labels to remove.
+        '''
+        if isinstance(to_add, _SCALAR_LABEL):
+            to_add = [to_add]
+
+        if isinstance(to_remove, _SCALAR_LABEL):
+            to_remove = [to_remove]
+
+        if not to_add and not to_remove:
+            return
+
+        add_ids = [
+            lbl.id if isinstance(lbl, Label) else await self._aget_or_create_label_id(lbl) for lbl in to_add
+        ]
+        remove_ids = [
+            lbl.id if isinstance(lbl, Label) else await self._aget_or_create_label_id(lbl) for lbl in to_remove
+        ]
+        res = await self._arequest('POST', f'messages/{self.id}/modify?fields=labelIds', {
+            'addLabelIds': add_ids,
+            'removeLabelIds': remove_ids
+        })
+        res_ids = res.get('labelIds', [])
+        applied = set(res_ids)
+
+        assert applied.issuperset(add_ids) and applied.isdisjoint(remove_ids), \
+            'An error occurred while modifying message label.'
+
+        self._set_label_ids(res_ids)
+
+
+class Message(AsyncMessage):
     '''
     The Message class for emails in your Gmail mailbox. This class should not
     be manually constructed. Contains all information about the associated
@@ -32,7 +432,22 @@ class Message:
         headers: a dict of header values. Default {}
         cc: who the message was cc'd on the message.
         bcc: who the message was bcc'd on the message.
+
+    Every field is passed in explicitly, so a Message can be built from a
+    partial (fields-masked) message resource as long as the fields above
+    are included.
     '''
+    # Mailboxes can hold many thousands of messages, slots keep each one small
+    __slots__ = (
+        'service', 'creds', 'user_id', 'id', 'thread_id', 'recipient', 'sender', 'subject',
+        'date', 'snippet', 'plain', 'html', 'label_ids', 'attachments', 'headers', 'cc', 'bcc'
+    )
+
+    # The system labels the label methods use, bound to the class
+    _UNREAD, _SPAM, _IMPORTANT, _STARRED, _INBOX, _TRASH = (
+        label.UNREAD, label.SPAM, label.IMPORTANT, label.STARRED, label.INBOX, label.TRASH
+    )
+
     def __init__(
         self,
         service: discovery.Resource,
@@ -67,49 +482,54 @@ class Message:
         self.html = html
         self.label_ids = label_ids or []
         self.attachments = attachments or []
-        self.headers = headers or {}
+        self.headers = headers if headers is not None else {}
         self.cc = cc or []
         self.bcc = bcc or []
 
+    @property
+    def _msgs(self) -> discovery.Resource:
+        'The messages collection of this message\'s service.'
+        return _messages_api(self.service)
+
     def mark_as_read(self):
         'Marks this message as read (by removing the UNREAD label)'
-        self.remove_label(label.UNREAD)
+        self.remove_label(self._UNREAD)
 
     def mark_as_unread(self):
         'Marks this message as unread (by adding the UNREAD label)'
-        self.add_label(label.UNREAD)
+        self.add_label(self._UNREAD)
 
     def mark_as_spam(self):
         'Marks this message as spam (by adding the SPAM label)'
-        self.add_label(label.SPAM)
+        self.add_label(self._SPAM)
 
     def mark_as_not_spam(self):
         'Marks this message as not spam (by removing the SPAM label)'
-        self.remove_label(label.SPAM)
+        self.remove_label(self._SPAM)
 
     def mark_as_important(self):
         'Marks this message as important (by adding the IMPORTANT label)'
-        self.add_label(label.IMPORTANT)
+        self.add_label(self._IMPORTANT)
 
     def mark_as_not_important(self):
         'Marks this message as not important (by removing the IMPORTANT label)'
-        self.remove_label(label.IMPORTANT)
+        self.remove_label(self._IMPORTANT)
 
     def star(self):
         'Stars this message (by adding the STARRED label)'
-        self.add_label(label.STARRED)
+        self.add_label(self._STARRED)
 
     def unstar(self):
         'Unstars this message (by removing the STARRED label)'
-        self.remove_label(label.STARRED)
+        self.remove_label(self._STARRED)
 
     def move_to_inbox(self):
         'Moves an archived message to your inbox (by adding the INBOX label)'
-        self.add_label(label.INBOX)
+        self.add_label(self._INBOX)
 
     def archive(self):
         'Archives the message (removes from inbox by removing the INBOX label)'
-        self.remove_label(label.INBOX)
+        self.remove_label(self._INBOX)
 
     def has_attachments(self) -> bool:
         'Returns whether this message has attachments'
@@ -117,19 +537,25 @@ class Message:
 
     def trash(self):
         'Moves this message to the trash'
-        res = self.service.users().messages().trash(userId=self.user_id, id=self.id).execute()
+        res = _execute_with_backoff(
+            self._msgs.trash(userId=self.user_id, id=self.id, fields='labelIds'), self.service, self.user_id
+        )
+        applied = res.get('labelIds', [])
 
-        assert label.TRASH in res['labelIds'], 'An error occurred in a call to `trash`.'
+        assert self._TRASH.id in applied, 'An error occurred in a call to `trash`.'
 
-        self.label_ids = res['labelIds']
+        self.label_ids = applied
 
     def untrash(self):
         'Removes this message from the trash'
-        res = self.service.users().messages().untrash(userId=self.user_id, id=self.id).execute()
+        res = _execute_with_backoff(
+            self._msgs.untrash(userId=self.user_id, id=self.id, fields='labelIds'), self.service, self.user_id
+        )
+        applied = res.get('labelIds', [])
 
-        assert label.TRASH not in res['labelIds'], 'An error occurred in a call to `untrash`.'
+        assert self._TRASH.id not in applied, 'An error occurred in a call to `untrash`.'
 
-        self.label_ids = res['labelIds']
+        self.label_ids = applied
 
     def move_from_inbox(self, to: Union[Label, str]):
         '''
@@ -138,7 +564,7 @@ class Message:
         Args:
             to: The label to move to.
         '''
-        self.modify_labels(to, label.INBOX)
+        self.modify_labels(to, self._INBOX)
 
     def add_label(self, to_add: Union[Label, str]):
         '''
@@ -147,7 +573,7 @@ class Message:
         Args:
             to_add: The label to add.
         '''
-        self.add_labels([to_add])
+        self._modify_one(add=to_add)
 
     def add_labels(self, to_add: Union[List[Label], List[str]]):
         '''
@@ -156,8 +582,10 @@ class Message:
         Args:
             to_add: The list of labels to add.
         '''
-        existing_labels = self.service.users().messages().get(userId=self.user_id, id=self.id).execute().get('labelIds', [])
-        to_add = [label for label in to_add if (label.id if isinstance(label, Label) else self._get_or_create_label_id(label)) not in existing_labels]
+        existing_labels = _execute_with_backoff(
+            self._msgs.get(userId=self.user_id, id=self.id, fields='labelIds'), self.service, self.user_id
+        ).get('labelIds', [])
+        to_add = [lbl for lbl in to_add if self._to_id(lbl) not in existing_labels]
         if to_add:
             self.modify_labels(to_add, [])
 
@@ -168,7 +596,7 @@ class Message:
         Args:
             to_remove: The label to remove.
         '''
-        self.remove_labels([to_remove])
+        self._modify_one(remove=to_remove)
 
     def remove_labels(self, to_remove: Union[List[Label], List[str]]):
         '''
@@ -179,20 +607,58 @@ class Message:
         '''
         self.modify_labels([], to_remove)
 
+    def _set_label_ids(self, label_ids: List[str]):
+        'Stores the message\'s labels, as returned by the API.'
+        self.label_ids = label_ids
+
+    def _to_id(self, lbl: Union[Label, str]) -> str:
+        'Returns the id of a Label, or of the label with the given name.'
+        return getattr(lbl, 'id', None) or self._get_or_create_label_id(lbl)
+
     def _get_or_create_label_id(self, label_name: str) -> str:
-        'Gets the label ID for the given label name, creating the label if it does not exist.'
-        labels = self.service.users().labels().list(userId=self.user_id).execute().get('labels', [])
-        for label in labels:
-            if label['name'].lower() == label_name.lower():
-                return label['id']
-        
+        '''
+        Gets the label ID for the given label name, creating the label if it
+        does not exist. The ids are cached per service, one labels.list call
+        serves every label name of the account.
+        '''
+        key = (self.user_id, label_name.lower())
+        ids = _label_ids_by_name.get(self.service)
+        if ids is not None and key in ids:
+            return ids[key]
+
+        with _label_ids_lock:
+            return self._lookup_or_create_label_id(label_name, key)
+
+    def _lookup_or_create_label_id(self, label_name: str, key: Tuple[str, str]) -> str:
+        '''
+        Fills the label id cache of the account from labels.list and creates
+        the label if it is missing. Called with _label_ids_lock held, so two
+        threads do not both create the same label.
+        '''
+        ids = _label_ids_by_name.get(self.service)
+        if ids is None:
+            ids = _label_ids_by_name.setdefault(self.service, {})
+
+        if key not in ids:
+            labels = _execute_with_backoff(
+                self.service.users().labels().list(userId=self.user_id, fields='labels(id,name)'),
+                self.service, self.user_id
+            ).get('labels', [])
+            ids.update(((self.user_id, lbl['name'].lower()), lbl['id']) for lbl in labels)
+        if key in ids:
+            return ids[key]
+
         # Create the label if it doesn't exist
         label = {
             'name': label_name,
             'labelListVisibility': 'labelShow',
             'messageListVisibility': 'show'
         }
-        created_label = self.service.users().labels().create(userId=self.user_id, body=label).execute()
+        # Not retried, a retry after a lost response could create the label twice
+        created_label = _execute(self.service.users().labels().create(
+            userId=self.user_id, body=label, fields='id'
+        ))
+        ids[key] = created_label['id']
         return created_label['id']
 
     def modify_labels(self, to_add: Union[Label, str, List[Label], List[str]],
@@ -204,36 +670,279 @@ class Message:
             to_add: The label or list of labels to add.
             to_remove: The label or list of labels to remove.
         '''
-        if isinstance(to_add, (Label, str)):
+        if isinstance(to_add, _SCALAR_LABEL):
             to_add = [to_add]
 
-        if isinstance(to_remove, (Label, str)):
+        if isinstance(to_remove, _SCALAR_LABEL):
             to_remove = [to_remove]
 
-        def create_update_labels() -> dict:
-            'Creates an object for updating message label.'
-            return {
-                'addLabelIds': [
-                    lbl.id if isinstance(lbl, Label) else self._get_or_create_label_id(lbl) for lbl in to_add
-                ],
-                'removeLabelIds': [
-                    lbl.id if isinstance(lbl, Label) else self._get_or_create_label_id(lbl) for lbl in to_remove
-                ]
-            }
-
-        if to_add or to_remove:
-            res = self.service.users().messages().modify(
-                userId=self.user_id, id=self.id, body=create_update_labels()
-            ).execute()
-
-            assert all((lbl.id if isinstance(lbl, Label) else self._get_or_create_label_id(lbl) in res['labelIds'] for lbl in to_add)) \
-                and all((lbl.id if isinstance(lbl, Label) else self._get_or_create_label_id(lbl) not in res['labelIds'] for lbl in to_remove)), \
-                'An error occurred while modifying message label.'
-
-            self.label_ids = res['labelIds']
-
-        assert all((lbl.id if isinstance(lbl, Label) else self._get_or_create_label_id(lbl) in res['labelIds'] for lbl in to_add)) \
-            and all((lbl.id if isinstance(lbl, Label) else self._get_or_create_label_id(lbl) not in res['labelIds'] for lbl in to_remove)), \
+        if not to_add and not to_remove:
+            return
+
+        # Label ids are looked up once and reused for the checks in _apply_modify
+        self._send_modify(self._build_modify_body(to_add, to_remove), to_add, to_remove)
+
+    def _modify_one(self, add: Optional[Union[Label, str]]=None, remove: Optional[Union[Label, str]]=None):
+        '''
+        Adds or removes a single label, without the list handling of
+        modify_labels.
+
+        Args:
+            add: The label to add. Default None.
+            remove: The label to remove. Default None.
+        '''
+        if add is not None:
+            self._send_modify({'addLabelIds': [self._to_id(add)], 'removeLabelIds': []}, [add], [])
+        else:
+            self._send_modify({'addLabelIds': [], 'removeLabelIds': [self._to_id(remove)]}, [], [remove])
+
+    def _send_modify(self, body: dict, to_add: Union[List[Label], List[str]],
+                     to_remove: Union[List[Label], List[str]]):
+        '''
+        Sends a modify call with the given body. When the call is rejected and
+        some labels were given by name, their cached ids may belong to labels
+        deleted since. The names are then looked up again, and the call is
+        retried once if any of them now has another id.
+
+        Args:
+            body: The request body, with the ids of to_add and to_remove.
+            to_add: The list of labels to add.
+            to_remove: The list of labels to remove.
+        '''
+        try:
+            self._apply_modify(body)
+        except HttpError as e:
+            names = [lbl for lbl in [*to_add, *to_remove] if isinstance(lbl, str)]
+            if e.resp.status not in _STALE_LABEL_STATUSES or not names:
+                raise
+            sent_ids = [self._to_id(name) for name in names]
+            self._forget_label_names(names)
+            if [self._to_id(name) for name in names] == sent_ids:
+                raise  # the ids were not stale, e.g. the message is gone
+            self._apply_modify(self._build_modify_body(to_add, to_remove))
+
+    def _forget_label_names(self, names: List[str]):
+        '''
+        Drops the cached ids of the given label names.
+
+        Args:
+            names: The label names.
+        '''
+        with _label_ids_lock:
+            ids = _label_ids_by_name.get(self.service, {})
+            for name in names:
+                ids.pop((self.user_id, name.lower()), None)
+
+    def _apply_modify(self, body: dict):
+        '''
+        Sends a modify call with the given body, checks that the labels were
+        changed and stores the message's new labels.
+
+        Args:
+            body: The request body, with label ids.
+        '''
+        res = _execute_with_backoff(
+            self._msgs.modify(userId=self.user_id, id=self.id, body=body, fields='labelIds'),
+            self.service, self.user_id
+        )
+        res_ids = res.get('labelIds', [])
+        applied = set(res_ids)
+
+        assert applied.issuperset(body['addLabelIds']) and applied.isdisjoint(body['removeLabelIds']), \
             'An error occurred while modifying message label.'
 
-        self.label_ids = res['labelIds']
+        self.label_ids = res_ids
+
+    def _build_modify_body(self, to_add: Union[Label, str, List[Label], List[str]],
+                           to_remove: Union[Label, str, List[Label], List[str]]) -> dict:
+        '''
+        Creates the request body for a modify call, looking up (or creating)
+        the ids of labels given by name.
+
+        Args:
+            to_add: The label or list of labels to add.
+            to_remove: The label or list of labels to remove.
+        Returns:
+            The request body.
+        '''
+        if isinstance(to_add, _SCALAR_LABEL):
+            to_add = [to_add]
+
+        if isinstance(to_remove, _SCALAR_LABEL):
+            to_remove = [to_remove]
+
+        # Label objects carry their id, strings are label names
+        to_id = self._to_id
+        return {
+            'addLabelIds': [to_id(lbl) for lbl in to_add],
+            'removeLabelIds': [to_id(lbl) for lbl in to_remove]
+        }
+
+    @classmethod
+    def _batch_execute(cls, messages: List['Message'],
+                       build_request: Callable[['Message', dict], discovery.HttpRequest],
+                       build_body: Optional[Callable[['Message'], dict]]=None):
+        '''
+        Executes one request per message, packing up to 100 requests into each
+        batch request, and updates the messages' labels from the responses.
+        Requests that fail inside a batch are retried on their own.
+
+        Args:
+            messages: The messages, possibly from several accounts.
+            build_request: Creates the request for a message, given the message
+                and the request body built for its account.
+            build_body: Creates the request body from one message of each
+                account. Default None, which passes an empty body.
+        '''
+        for group in _group_by_account(messages):
+            body = build_body(group[0]) if build_body else {}
+            service = group[0].service
+
+            if not hasattr(service, 'new_batch_http_request'):
+                for msg in group:
+                    msg.label_ids = _execute_with_backoff(build_request(msg, body), msg.service, msg.user_id) \
+                        .get('labelIds', [])
+                continue
+
+            for start in range(0, len(group), _MAX_BATCH_SIZE):
+                chunk = group[start:start + _MAX_BATCH_SIZE]
+                failed: List[Message] = []
+
+                batch = service.new_batch_http_request(callback=_label_ids_callback(chunk, failed))
+                for i, msg in enumerate(chunk):
+                    batch.add(build_request(msg, body), request_id=str(i))
+                _execute_with_backoff(batch, service, chunk[0].user_id, tries=1, units=5 * len(chunk))
+
+                for msg in failed:
+                    msg.label_ids = _execute_with_backoff(build_request(msg, body), msg.service, msg.user_id) \
+                        .get('labelIds', [])
+
+    @classmethod
+    def batch_modify(cls, messages: List['Message'], to_add: Union[Label, str, List[Label], List[str]],
+                     to_remove: Union[Label, str, List[Label], List[str]]):
+        '''
+        Adds or removes the specified labels on many messages, sending up to
+        100 modify calls per HTTP request.
+
+        Args:
+            messages: The messages to modify.
+            to_add: The label or list of labels to add.
+            to_remove: The label or list of labels to remove.
+        '''
+        cls._batch_execute(
+            messages,
+            lambda msg, body: msg._msgs.modify(userId=msg.user_id, id=msg.id, body=body, fields='labelIds'),
+            lambda msg: msg._build_modify_body(to_add, to_remove)
+        )
+
+    @classmethod
+    def batch_add_labels(cls, messages: List['Message'], to_add: Union[Label, str, List[Label], List[str]]):
+        '''
+        Adds the given labels to many messages, sending up to 100 modify calls
+        per HTTP request.
+
+        Args:
+            messages: The messages to modify.
+            to_add: The label or list of labels to add.
+        '''
+        cls.batch_modify(messages, to_add, [])
+
+    @classmethod
+    def batch_trash(cls, messages: List['Message']):
+        '''
+        Moves many messages to the trash, sending up to 100 trash calls per
+        HTTP request.
+
+        Args:
+            messages: The messages to trash.
+        '''
+        cls._batch_execute(
+            messages,
+            lambda msg, body: msg._msgs.trash(userId=msg.user_id, id=msg.id, fields='labelIds')
+        )
+
+    @classmethod
+    def _bulk(cls, messages: List['Message'], to_add: Union[Label, str, List[Label], List[str]],
+              to_remove: Union[Label, str, List[Label], List[str]]):
+        '''
+        Applies the same label change to many messages with batchModify, one
+        call per 1000 messages of an account. batchModify returns no content,
+        so the messages' labels are updated locally.
+
+        Args:
+            messages: The messages to modify, possibly from several accounts.
+            to_add: The label or list of labels to add.
+            to_remove: The label or list of labels to remove.
+        '''
+        for group in _group_by_account(messages):
+            body = group[0]._build_modify_body(to_add, to_remove)
+            if not body['addLabelIds'] and not body['removeLabelIds']:
+                continue
+
+            for start in range(0, len(group), _MAX_BATCH_MODIFY_SIZE):
+                chunk = group[start:start + _MAX_BATCH_MODIFY_SIZE]
+                _execute_with_backoff(
+                    chunk[0]._msgs.batchModify(
+                        userId=chunk[0].user_id, body={'ids': [msg.id for msg in chunk], **body}
+                    ),
+                    chunk[0].service, chunk[0].user_id
+                )
+
+            for msg in group:
+                current = [getattr(lbl, 'id', lbl) for lbl in msg.label_ids]
+                msg.label_ids = [x for x in current if x not in body['removeLabelIds']] \
+                    + [x for x in body['addLabelIds'] if x not in current]
+
+    @classmethod
+    def bulk_mark_as_read(cls, messages: List['Message']):
+        'Marks the given messages as read (by removing the UNREAD label)'
+        cls._bulk(messages, [], cls._UNREAD)
+
+    @classmethod
+    def bulk_mark_as_unread(cls, messages: List['Message']):
+        'Marks the given messages as unread (by adding the UNREAD label)'
+        cls._bulk(messages, cls._UNREAD, [])
+
+    @classmethod
+    def bulk_archive(cls, messages: List['Message']):
+        'Archives the given messages (by removing the INBOX label)'
+        cls._bulk(messages, [], cls._INBOX)
+
+    @classmethod
+    def bulk_star(cls, messages: List['Message']):
+        'Stars the given messages (by adding the STARRED label)'
+        cls._bulk(messages, cls._STARRED, [])
+
+    @classmethod
+    def parallel_apply(cls, messages: List['Message'], method: Union[str, Callable[['Message'], Any]],
+                       *args, max_workers: int=10) -> List[Any]:
+        '''
+        Calls a method on each of the given messages from a pool of threads,
+        so that up to max_workers requests are in flight at once. Each thread
+        sends the requests of Message methods over its own HTTP connection.
+        Other calls, such as Attachment.download or Gmail methods, still use
+        the service's connection, which is not thread-safe, so method should
+        not make them. Prefer batch_modify or the bulk methods when they fit,
+        they need far fewer requests.
+
+        Example:
+            Message.parallel_apply(messages, 'add_label', label.STARRED)
+
+        Args:
+            messages: The messages.
+            method: The name of the Message method to call, or a function
+                taking the message.
+            *args: The arguments to pass to the method.
+            max_workers: The number of threads. Default 10. Requests are
+                rate limited to the user's quota however many threads run.
+        Returns:
+            The return values, in the order of the messages.
+        '''
+        def apply(msg: Message) -> Any:
+            _thread_http(msg.creds)
+            if callable(method):
+                return method(msg, *args)
+            return getattr(msg, method)(*args)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(apply, messages))
@@ -0,0 +1,208 @@
+import contextlib
+import datetime
+import mimetypes
+import mmap
+import os
+import stat
+from typing import Dict, Iterator, Optional, Union
+
+from bs4 import BeautifulSoup
+
+try:
+    from pybase64 import urlsafe_b64decode
+except ImportError:
+    from base64 import urlsafe_b64decode
+
+try:
+    import puremagic
+except ImportError:
+    puremagic = None
+
+mimetypes.init()
+
+# Number of leading bytes of an attachment file used to sniff its content type
+_SNIFF_SIZE = 512
+
+# Content types of attachment files, keyed by lowercased file extension, or None when
+# the extension does not tell. Seeded with the most common types.
+_EXT_CACHE: Dict[str, Optional[str]] = {
+    '.pdf': 'application/pdf',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.zip': 'application/zip',
+}
+
+
+def _parse_date_header(value: str) -> str:
+    'Converts a Date header to local time, returning it unchanged if it cannot be parsed.'
+    try:
+        return str(datetime.datetime.strptime(value, '%d %b %Y %H:%M:%S %z').astimezone())
+    except ValueError:
+        return value
+
+def _html_part(data: str) -> dict:
+    'Decodes the body of a text/html message part.'
+    return {'part_type': 'html', 'body': urlsafe_b64decode(data).decode('utf-8', 'replace')}
+
+def _parsed_html_part(data: str) -> dict:
+    'Decodes the body of a text/html message part, keeping only its body element.'
+    body = BeautifulSoup(urlsafe_b64decode(data), 'lxml', from_encoding='utf-8').body
+    return {'part_type': 'html', 'body': str(body)}
+
+def _plain_part(data: str) -> dict:
+    'Decodes the body of a text/plain message part.'
+    return {'part_type': 'plain', 'body': urlsafe_b64decode(data).decode('UTF-8')}
+
+# Maps the mime types of message body parts to the function decoding them
+_LEAF_HANDLERS = {
+    'text/html': _html_part,
+    'text/plain': _plain_part,
+}
+_PARSED_LEAF_HANDLERS = {**_LEAF_HANDLERS, 'text/html': _parsed_html_part}
+
+def _guess_content_type(filepath: str, head: bytes=b'') -> str:
+    '''
+    Guesses the content type of an attachment file from its extension. If the
+    extension does not tell and puremagic is installed, the type is sniffed from
+    head, the first bytes of the file. Sniffed text types are not used, since
+    text attachments are decoded as UTF-8 and a sniffed file may not be.
+    '''
+    ext = os.path.splitext(filepath)[1].lower()
+    try:
+        content_type = _EXT_CACHE[ext]
+    except KeyError:
+        content_type, encoding = mimetypes.guess_type(filepath)
+        if encoding is not None:
+            content_type = None
+        content_type = _EXT_CACHE.setdefault(ext, content_type)
+
+    if content_type is None and puremagic is not None and head:
+        try:
+            content_type = puremagic.from_string(head, mime=True) or None
+        except (puremagic.PureError, ValueError):
+            pass
+        if content_type is not None and content_type.startswith('text/'):
+            content_type = None
+
+    return content_type or 'application/octet-stream'
+
+@contextlib.contextmanager
+def _map_file(filepath: str) -> Iterator[Union[mmap.mmap, bytes]]:
+    '''
+    Yields the contents of a file, memory-mapped instead of read into a bytes
+    object. Empty files cannot be mapped, and files that are not regular files
+    (pipes, /proc files) may report a size of 0 while having content, so those
+    are read.
+    '''
+    with open(filepath, 'rb') as file:
+        info = os.fstat(file.fileno())
+        if not stat.S_ISREG(info.st_mode) or info.st_size == 0:
+            yield file.read()
+        else:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+
+# Maps lowercased header names to a handler returning the Message field and its value
+_HDR_HANDLERS = {
+    'date': lambda value: ('date', _parse_date_header(value)),
+    'from': lambda value: ('sender', value),
+    'to': lambda value: ('recipient', value),
+    'subject': lambda value: ('subject', value),
+    'cc': lambda value: ('cc', value.split(', ')),
+    'bcc': lambda value: ('bcc', value.split(', ')),
+}
+
+
+class _CIHeaderDict(dict):
+    '''
+    The headers of a message keyed by their original names, which can also be
+    looked up case-insensitively, e.g. headers['message-id'] finds 'Message-ID'.
+    '''
+    def __init__(self, headers: Optional[Dict[str, str]]=None):
+        super().__init__()
+        # Lowercased name to the name the header is stored under
+        self._names: Dict[str, str] = {}
+        if headers:
+            for name, value in headers.items():
+                self[name] = value
+
+    def add_header(self, name: str, lower: str, value: str):
+        '''Stores a header whose lowercased name is already known.'''
+        dict.__setitem__(self, self._names.setdefault(lower, name), value)
+
+    def __setitem__(self, key: str, value: str):
+        self.add_header(key, key.lower(), value)
+
+    def __delitem__(self, key: str):
+        name = self._names.pop(key.lower(), key)
+        dict.__delitem__(self, name)
+
+    def __missing__(self, key: str):
+        name = self._names.get(key.lower()) if isinstance(key, str) else None
+        if name is None or not dict.__contains__(self, name):
+            raise KeyError(key)
+        return dict.__getitem__(self, name)
+
+    def __contains__(self, key: object) -> bool:
+        if dict.__contains__(self, key):
+            return True
+        return isinstance(key, str) and dict.__contains__(self, self._names.get(key.lower()))
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key: str, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key: str, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        name, value = dict.popitem(self)
+        self._names.pop(name.lower(), None)
+        return name, value
+
+    def clear(self):
+        dict.clear(self)
+        self._names.clear()
+
+    def update(self, *args, **kwargs):
+        for name, value in dict(*args, **kwargs).items():
+            self[name] = value
+
+    def copy(self) -> '_CIHeaderDict':
+        return type(self)(self)
+
+    def __or__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        merged = self.copy()
+        merged.update(other)
+        return merged
+
+    def __ror__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        merged = type(self)(other)
+        merged.update(self)
+        return merged
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
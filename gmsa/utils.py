@@ -1,16 +1,64 @@
 import re
+from email import base64mime, quoprimime
 from email.utils import formataddr
-from email.header import Header
+from functools import lru_cache
+
+# Matches a `Name <address>` or `"Name" <address>` string
+_ADDR_RE = re.compile(r'\s*"?([^"<]+?)"?\s*<([^>]+)>\s*')
+
+# The characters that make formataddr quote a display name
+_SPECIALS_RE = re.compile(r'[][\\()<>@,:;".]')
+
+
+@lru_cache(maxsize=1024)
+def _encode_name(name):
+    # The same senders and recipients come up over and over again.
+    # Builds the RFC 2047 encoded word directly, picking the shorter of Q and
+    # B encoding like email.charset does for utf-8
+    raw = name.encode('utf-8')
+    if base64mime.header_length(raw) < quoprimime.header_length(raw):
+        return base64mime.header_encode(raw, 'utf-8')
+    return quoprimime.header_encode(raw, 'utf-8')
+
+
+def _split_address(input_str):
+    # Splits the usual `Name <address>` form with plain string operations,
+    # returns None for anything else
+    stripped = input_str.strip()
+    if not stripped.endswith('>'):
+        return None
+
+    name, _, email = stripped[:-1].rpartition('<')
+    name = name.strip()
+    if name.startswith('"'):
+        name = name[1:]
+    if name.endswith('"'):
+        name = name[:-1]
+
+    if not name or not email or '"' in name or '<' in name or '>' in email:
+        return None
+    return name, email
+
 
 def extract_and_format_to_header(input_str):
-    # Regular expression to extract name and email
-    match = re.match(r'"?([^"]+)"? <(.+)>', input_str)
-    if not match:
-        raise ValueError(f"Input string: {input_str} is not in the correct format")
+    parts = _split_address(input_str)
+    if parts is None:
+        # Regular expression to extract name and email
+        match = _ADDR_RE.fullmatch(input_str)
+        if not match:
+            raise ValueError(f"Input string: {input_str} is not in the correct format")
+        parts = match.groups()
+
+    recipient_name, recipient_email = parts
+
+    # Properly format the "To" header, only non-ASCII names need encoding
+    if not recipient_name.isascii():
+        recipient_name = _encode_name(recipient_name)
 
-    recipient_name, recipient_email = match.groups()
+    # Names without specials need no quoting, which is all formataddr would add
+    if recipient_email.isascii() and not _SPECIALS_RE.search(recipient_name):
+        return f'{recipient_name} <{recipient_email}>'
 
-    # Properly format the "To" header
-    to_header = formataddr((str(Header(recipient_name, 'utf-8')), recipient_email))
+    to_header = formataddr((recipient_name, recipient_email))
 
     return to_header
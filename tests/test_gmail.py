@@ -0,0 +1,290 @@
+from base64 import urlsafe_b64encode
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.multipart import MIMEMultipart
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from gmsa.authentication import AuthenticatedService
+from gmsa.gmail import Gmail
+
+
+class FakeRequest(object):
+
+    def __init__(self, response, error=None):
+        self.response = response
+        self.error = error
+
+    def execute(self, **kwargs):
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+class FakeBatch(object):
+    'Executes the added requests one by one, reporting each to the callback like a batch request.'
+
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, **kwargs):
+        self.service.batch_sizes.append(len(self.requests))
+        for request_id, request in self.requests:
+            try:
+                response = request.execute()
+            except HttpError as e:
+                self.callback(request_id, None, e)
+            else:
+                self.callback(request_id, response, None)
+
+
+class FakeLabelsService(object):
+    'Answers labels().list() with a different set of labels for each user.'
+
+    def __init__(self, labels_by_user):
+        self.labels_by_user = labels_by_user
+        self.calls = []
+
+    def users(self):
+        return self
+
+    def labels(self):
+        return self
+
+    def list(self, userId, **kwargs):
+        self.calls.append(userId)
+        return FakeRequest({'labels': self.labels_by_user[userId]})
+
+
+def b64(data):
+    return urlsafe_b64encode(data).decode()
+
+
+def make_payload():
+    'A multipart/mixed payload: an alternative text and html body, then two attachments.'
+    return {
+        'mimeType': 'multipart/mixed', 'body': {'size': 0}, 'parts': [
+            {'mimeType': 'multipart/alternative', 'body': {'size': 0}, 'parts': [
+                {'mimeType': 'text/plain', 'body': {'data': b64('Hi Müller'.encode())}},
+                {'mimeType': 'text/html', 'body': {'data': b64(b'<html><body><p>Hi</p></body></html>')}},
+            ]},
+            {'mimeType': 'image/png', 'filename': 'logo.png',
+             'body': {'attachmentId': 'att1', 'size': 4, 'data': b64(b'\x89PNG')}},
+            {'mimeType': 'application/pdf', 'filename': '',
+             'body': {'attachmentId': 'att2', 'size': 90000}},
+        ]
+    }
+
+
+class FakeGmailService(object):
+    '''
+    A mailbox of messages m0, m1, ..., each with one PDF attachment. The
+    messages and attachments whose ids are in failing are rate limited once.
+    '''
+
+    def __init__(self, n, attachment_size=10, batch=True, failing=()):
+        self.n = n
+        self.attachment_size = attachment_size
+        self.failing = set(failing)
+        self.calls = []
+        self.batch_sizes = []
+        if batch:
+            self.new_batch_http_request = lambda callback: FakeBatch(self, callback)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def attachments(self):
+        return self
+
+    def labels(self):
+        return self
+
+    def list(self, userId, **kwargs):
+        if 'q' not in kwargs:
+            self.calls.append(('labels.list', userId))
+            return FakeRequest({'labels': [{'id': 'INBOX', 'name': 'INBOX'}]})
+
+        self.calls.append(('messages.list', kwargs['maxResults']))
+        start = int(kwargs['pageToken'] or 0)
+        end = min(start + kwargs['maxResults'], self.n)
+        response = {'messages': [{'id': f'm{i}', 'threadId': f't{i}'} for i in range(start, end)]}
+        if end < self.n:
+            response['nextPageToken'] = str(end)
+        return FakeRequest(response)
+
+    def get(self, userId, id, messageId=None, fields=None):
+        if messageId is not None:
+            self.calls.append(('attachments.get', id))
+            response = {'data': b64(id.encode()), 'size': self.attachment_size}
+        else:
+            self.calls.append(('messages.get', id))
+            response = self.message_resource(id)
+
+        error = None
+        if id in self.failing:
+            self.failing.discard(id)
+            error = HttpError(httplib2.Response({'status': 429}), b'Rate Limit Exceeded')
+        return FakeRequest(response, error)
+
+    def message_resource(self, msg_id):
+        return {
+            'id': msg_id, 'threadId': 't', 'labelIds': ['INBOX'], 'snippet': '',
+            'payload': {
+                'mimeType': 'multipart/mixed', 'headers': [{'name': 'Subject', 'value': msg_id}],
+                'body': {'size': 0}, 'parts': [
+                    {'mimeType': 'text/plain', 'body': {'data': b64(b'Hi')}},
+                    {'mimeType': 'application/pdf', 'filename': f'{msg_id}.pdf',
+                     'body': {'attachmentId': f'a{msg_id}', 'size': self.attachment_size}},
+                ]
+            }
+        }
+
+    def count(self, name):
+        return sum(1 for call in self.calls if call[0] == name)
+
+
+def make_gmail(service):
+    g = Gmail.__new__(Gmail)
+    g.service = service
+    g.credentials = None
+    g._label_cache = {}
+    g._executor = ThreadPoolExecutor(max_workers=4)
+    return g
+
+
+def refs(n):
+    return [{'id': f'm{i}', 'threadId': f't{i}'} for i in range(n)]
+
+
+class TestGmail(object):
+
+    def test_ready_message_with_attachments_non_utf8_text_file(self, tmp_path):
+        path = tmp_path / 'contact'
+        path.write_bytes(b'BEGIN:VCARD\r\nVERSION:3.0\r\nFN:Ren\xe9\r\nEND:VCARD\r\n')
+        msg = MIMEMultipart()
+        Gmail.__new__(Gmail)._ready_message_with_attachments(msg, [str(path)])
+
+        attm = msg.get_payload()[0]
+        assert attm.get_content_type() == 'application/octet-stream'
+        assert attm.get_payload(decode=True) == path.read_bytes()
+
+    def test_get_label_map_is_kept_per_user(self):
+        service = FakeLabelsService({
+            'alice@example.com': [{'id': 'Label_1', 'name': 'Invoices'}],
+            'bob@example.com': [{'id': 'Label_1', 'name': 'Holidays'}],
+        })
+        g = make_gmail(service)
+
+        assert g._get_label_map('alice@example.com')['Label_1'].name == 'Invoices'
+        assert g._get_label_map('bob@example.com')['Label_1'].name == 'Holidays'
+        assert g._get_label_map('alice@example.com')['Label_1'].name == 'Invoices'
+        assert service.calls == ['alice@example.com', 'bob@example.com']
+
+    def test_evaluate_message_payload_keeps_part_order(self):
+        parts = make_gmail(None)._evaluate_message_payload(make_payload())
+
+        assert [part['part_type'] for part in parts] == ['plain', 'html', 'attachment', 'attachment']
+        assert parts[0]['body'] == 'Hi Müller'
+        assert parts[1]['body'] == '<html><body><p>Hi</p></body></html>'
+        assert [part['filename'] for part in parts[2:]] == ['logo.png', 'unknown']
+        assert [part['data'] for part in parts[2:]] == [None, None]
+
+    def test_evaluate_message_payload_parse_html(self):
+        parts = make_gmail(None)._evaluate_message_payload(make_payload(), parse_html=True)
+
+        assert parts[1] == {'part_type': 'html', 'body': '<body><p>Hi</p></body>'}
+
+    def test_evaluate_message_payload_decodes_inline_attachment_data(self):
+        parts = make_gmail(None)._evaluate_message_payload(make_payload(), attachments='download')
+
+        assert parts[2]['data'] == b'\x89PNG'
+        assert parts[3]['data'] is None  # downloaded afterwards, in a batch
+
+    def test_evaluate_message_payload_ignore_attachments(self):
+        parts = make_gmail(None)._evaluate_message_payload(make_payload(), attachments='ignore')
+
+        assert [part['part_type'] for part in parts] == ['plain', 'html']
+
+    def test_get_messages_from_refs_batches_100_calls(self):
+        service = FakeGmailService(250)
+        msgs = make_gmail(service)._get_messages_from_refs('me', refs(250))
+
+        assert service.batch_sizes == [100, 100, 50]
+        assert [msg.id for msg in msgs] == [f'm{i}' for i in range(250)]
+        assert [msg.subject for msg in msgs[98:102]] == ['m98', 'm99', 'm100', 'm101']
+        assert service.count('labels.list') == 1
+
+    def test_get_messages_from_refs_refetches_failed_calls(self):
+        service = FakeGmailService(150, failing={'m3', 'm120'})
+        msgs = make_gmail(service)._get_messages_from_refs('me', refs(150))
+
+        assert service.batch_sizes == [100, 50]
+        assert [msg.id for msg in msgs] == [f'm{i}' for i in range(150)]
+        assert service.calls.count(('messages.get', 'm3')) == 2
+        assert service.calls.count(('messages.get', 'm120')) == 2
+        assert service.count('messages.get') == 152
+
+    def test_get_messages_from_refs_downloads_attachments_in_batches(self):
+        service = FakeGmailService(150, failing={'am7'})
+        msgs = make_gmail(service)._get_messages_from_refs('me', refs(150), attachments='download')
+
+        # Two batches of messages, then two of attachments
+        assert service.batch_sizes == [100, 50, 100, 50]
+        assert [msg.attachments[0].data for msg in msgs[:8]] == [f'am{i}'.encode() for i in range(8)]
+        assert service.calls.count(('attachments.get', 'am7')) == 2
+
+    def test_batch_download_attachments_splits_by_size(self):
+        service = FakeGmailService(5, attachment_size=4 * 2**20)
+        msgs = make_gmail(service)._get_messages_from_refs('me', refs(5), attachments='download')
+
+        # At most 10 MiB of attachments per batch
+        assert service.batch_sizes == [5, 2, 2, 1]
+        assert all(msg.attachments[0].data == f'am{i}'.encode() for i, msg in enumerate(msgs))
+
+    def test_get_messages_from_refs_without_batch_requests(self, monkeypatch):
+        monkeypatch.setattr(AuthenticatedService, '_build_http', staticmethod(lambda credentials: None))
+        service = FakeGmailService(30, batch=False)
+        msgs = make_gmail(service)._get_messages_from_refs('me', refs(30), attachments='download')
+
+        assert [msg.id for msg in msgs] == [f'm{i}' for i in range(30)]
+        assert [msg.attachments[0].data for msg in msgs] == [f'am{i}'.encode() for i in range(30)]
+        assert service.count('messages.get') == 30
+        assert service.count('attachments.get') == 30
+        assert service.batch_sizes == []
+
+    def test_get_messages_limit_spans_pages(self):
+        service = FakeGmailService(1200)
+        msgs = make_gmail(service).get_messages(limit=700)
+
+        assert [call for call in service.calls if call[0] == 'messages.list'] == [
+            ('messages.list', 500), ('messages.list', 200)
+        ]
+        assert [msg.id for msg in msgs] == [f'm{i}' for i in range(700)]
+
+    def test_get_messages_without_limit_gets_every_page(self):
+        service = FakeGmailService(1200)
+        msgs = make_gmail(service).get_messages()
+
+        assert service.count('messages.list') == 3
+        assert len(msgs) == 1200
+
+    def test_get_messages_limit_zero_makes_no_call(self):
+        service = FakeGmailService(10)
+
+        assert make_gmail(service).get_messages(limit=0) == []
+        assert service.calls == []
+
+    def test_get_messages_no_match_does_not_list_labels(self):
+        service = FakeGmailService(0)
+
+        assert make_gmail(service).get_messages(query='from:nobody@example.com') == []
+        assert service.calls == [('messages.list', 500)]
@@ -0,0 +1,486 @@
+import asyncio
+import threading
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from gmsa import label, message
+from gmsa.message import Message
+
+
+class FakeClock(object):
+    'Stands in for the time module, sleeping by moving the clock forward.'
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeRequest(object):
+
+    def __init__(self, response=None, methodId=None):
+        self.response = response
+        self.methodId = methodId
+
+    def execute(self, **kwargs):
+        return self.response
+
+
+class FakeMessagesService(object):
+    'Records the batchModify calls of users().messages().'
+
+    def __init__(self):
+        self.batch_modify_bodies = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def batchModify(self, userId, body):
+        self.batch_modify_bodies.append((userId, body))
+        return FakeRequest('')
+
+
+class FakeBatch(object):
+    'Executes the added requests one by one, reporting each to the callback like a batch request.'
+
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, **kwargs):
+        self.service.batch_sizes.append(len(self.requests))
+        for request_id, request in self.requests:
+            try:
+                response = request.execute()
+            except HttpError as e:
+                self.callback(request_id, None, e)
+            else:
+                self.callback(request_id, response, None)
+
+
+class FailingRequest(FakeRequest):
+
+    def __init__(self, status):
+        super().__init__()
+        self.status = status
+
+    def execute(self, **kwargs):
+        raise HttpError(httplib2.Response({'status': self.status}), b'')
+
+
+class FakeBatchService(object):
+    '''
+    Answers modify and trash calls of users().messages(), from new batch
+    requests too, and the labels calls. Every message starts in the inbox,
+    unread. The calls for the message ids in failing are rate limited once,
+    and modify calls with unknown label ids or message ids in missing fail.
+    '''
+
+    def __init__(self, failing=(), missing=(), user_labels=None):
+        self.failing = set(failing)
+        self.missing = set(missing)
+        self.user_labels = dict(user_labels or {})
+        self.msg_labels = {}
+        self.calls = []
+        self.batch_sizes = []
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def labels(self):
+        return self
+
+    def list(self, userId, fields=None):
+        self.calls.append(('labels.list', userId))
+        return FakeRequest({'labels': [{'id': id_, 'name': name} for name, id_ in self.user_labels.items()]})
+
+    def create(self, userId, body, fields=None):
+        self.calls.append(('labels.create', userId, body['name']))
+        self.user_labels[body['name']] = f'Label_{len(self.user_labels) + 1}'
+        return FakeRequest({'id': self.user_labels[body['name']]})
+
+    def _call(self, name, userId, id, add=(), remove=()):
+        self.calls.append((name, userId, id))
+        if id in self.failing:
+            self.failing.discard(id)
+            return FailingRequest(429)
+        current = self.msg_labels.get(id, ['INBOX', 'UNREAD'])
+        self.msg_labels[id] = [x for x in current if x not in remove] + [x for x in add if x not in current]
+        return FakeRequest({'id': id, 'labelIds': self.msg_labels[id]})
+
+    def modify(self, userId, id, body, fields=None):
+        known = {'INBOX', 'UNREAD', 'STARRED', *self.user_labels.values()}
+        if id in self.missing:
+            return FailingRequest(404)
+        if not known.issuperset(body['addLabelIds'] + body['removeLabelIds']):
+            self.calls.append(('modify', userId, id))
+            return FailingRequest(400)
+        return self._call('modify', userId, id, body['addLabelIds'], body['removeLabelIds'])
+
+    def trash(self, userId, id, fields=None):
+        return self._call('trash', userId, id, ['TRASH'])
+
+
+def make_message(service, msg_id, label_ids, user_id='me'):
+    return Message(service, None, user_id, msg_id, 'thread', 'to@example.com', 'from@example.com',
+                   'Subject', '2024-01-01', 'snippet', label_ids=label_ids)
+
+
+class FakeCredentials(object):
+    'Credentials that are expired until refreshed, counting the refreshes.'
+
+    def __init__(self):
+        self.valid = False
+        self.token = None
+        self.refreshes = 0
+        self._lock = threading.Lock()
+
+    def refresh(self, request):
+        with self._lock:
+            self.refreshes += 1
+            self.token = f'token{self.refreshes}'
+            self.valid = True
+
+
+class FakeResponse(object):
+
+    def __init__(self, status, data):
+        self.status = status
+        self.data = data
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise RuntimeError(f'HTTP {self.status}')
+
+    async def json(self):
+        return self.data
+
+
+class FakeSession(object):
+    '''
+    Stands in for aiohttp.ClientSession, answering the Gmail REST calls of the
+    async methods. The first statuses in queued_statuses are returned before
+    any real answer.
+    '''
+    instances = []
+
+    def __init__(self):
+        self.closed = False
+        self.calls = []
+        self.queued_statuses = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.user_labels = {'Invoices': 'Label_1'}
+        self.msg_labels = {}
+        FakeSession.instances.append(self)
+
+    async def close(self):
+        self.closed = True
+
+    def request(self, method, url, json=None, headers=None):
+        return _FakeRequestContext(self, method, url, json, headers)
+
+    def answer(self, method, url, body):
+        path = url.split('/users/me/', 1)[1]
+        if path.startswith('labels') and method == 'GET':
+            return {'labels': [{'id': id_, 'name': name} for name, id_ in self.user_labels.items()]}
+        if path.startswith('labels'):
+            self.user_labels[body['name']] = f'Label_{len(self.user_labels) + 1}'
+            return {'id': self.user_labels[body['name']]}
+
+        msg_id = path.split('/')[1]
+        current = self.msg_labels.get(msg_id, ['INBOX', 'UNREAD'])
+        self.msg_labels[msg_id] = [x for x in current if x not in body['removeLabelIds']] \
+            + [x for x in body['addLabelIds'] if x not in current]
+        return {'id': msg_id, 'labelIds': self.msg_labels[msg_id]}
+
+
+class _FakeRequestContext(object):
+
+    def __init__(self, session, method, url, body, headers):
+        self.session = session
+        self.args = (method, url, body, headers)
+
+    async def __aenter__(self):
+        session = self.session
+        method, url, body, headers = self.args
+        session.calls.append((method, url.split('/users/me/', 1)[1], headers['Authorization']))
+        session.in_flight += 1
+        session.max_in_flight = max(session.max_in_flight, session.in_flight)
+        await _real_sleep(0)  # lets the other requests start
+        if session.queued_statuses:
+            return FakeResponse(session.queued_statuses.pop(0), {})
+        return FakeResponse(200, session.answer(method, url, body))
+
+    async def __aexit__(self, *exc_info):
+        self.session.in_flight -= 1
+
+
+_real_sleep = asyncio.sleep
+
+
+@pytest.fixture
+def aio(monkeypatch):
+    aiohttp = pytest.importorskip('aiohttp')
+    FakeSession.instances = []
+    monkeypatch.setattr(aiohttp, 'ClientSession', FakeSession)
+    monkeypatch.setattr(message, '_aio', message._AioState())
+
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+        await _real_sleep(0)
+
+    monkeypatch.setattr(asyncio, 'sleep', sleep)
+    return sleeps
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(message, 'time', clock)
+    return clock
+
+
+class TestRateLimiter(object):
+
+    def test_acquire_within_the_bucket_does_not_wait(self, clock):
+        limiter = message._RateLimiter(10)
+        limiter.acquire(4)
+        limiter.acquire(6)
+
+        assert clock.sleeps == []
+
+    def test_acquire_waits_for_the_bucket_to_refill(self, clock):
+        limiter = message._RateLimiter(10)
+        limiter.acquire(10)
+        limiter.acquire(5)
+
+        assert clock.sleeps == [pytest.approx(0.5)]
+
+    def test_acquire_more_than_the_bucket_waits_for_a_full_bucket(self, clock):
+        limiter = message._RateLimiter(10)
+        limiter.acquire(5)
+        limiter.acquire(25)
+        assert clock.sleeps == [pytest.approx(0.5)]
+
+        # The bucket is left 15 units in debt
+        limiter.acquire(10)
+        assert clock.sleeps[1] == pytest.approx(2.5)
+
+    def test_execute_with_backoff_keeps_one_limiter_per_user(self, clock):
+        service = FakeMessagesService()
+        message._execute_with_backoff(FakeRequest({}), service, 'alice@example.com')
+        message._execute_with_backoff(FakeRequest({}), service, 'bob@example.com')
+        message._execute_with_backoff(FakeRequest({}), service, 'alice@example.com')
+
+        limiters = message._rate_limiters[service]
+        assert sorted(limiters) == ['alice@example.com', 'bob@example.com']
+        assert limiters['alice@example.com'] is not limiters['bob@example.com']
+
+
+class TestMessage(object):
+
+    def test_bulk_updates_label_ids_locally(self, clock):
+        service = FakeMessagesService()
+        msgs = [
+            make_message(service, 'm1', ['INBOX', 'UNREAD']),
+            make_message(service, 'm2', [label.INBOX, label.STARRED]),
+        ]
+        Message._bulk(msgs, [label.STARRED], [label.UNREAD])
+
+        assert service.batch_modify_bodies == [('me', {
+            'ids': ['m1', 'm2'], 'addLabelIds': ['STARRED'], 'removeLabelIds': ['UNREAD']
+        })]
+        assert msgs[0].label_ids == ['INBOX', 'STARRED']
+        assert msgs[1].label_ids == ['INBOX', 'STARRED']
+
+    def test_bulk_groups_messages_by_user(self, clock):
+        service = FakeMessagesService()
+        msgs = [
+            make_message(service, 'm1', ['INBOX'], user_id='alice@example.com'),
+            make_message(service, 'm2', ['INBOX'], user_id='bob@example.com'),
+            make_message(service, 'm3', ['INBOX'], user_id='alice@example.com'),
+        ]
+        Message.bulk_star(msgs)
+
+        assert [(user_id, body['ids']) for user_id, body in service.batch_modify_bodies] == [
+            ('alice@example.com', ['m1', 'm3']), ('bob@example.com', ['m2'])
+        ]
+        assert all(msg.label_ids == ['INBOX', 'STARRED'] for msg in msgs)
+
+    def test_bulk_without_label_changes_makes_no_call(self, clock):
+        service = FakeMessagesService()
+        msg = make_message(service, 'm1', ['INBOX'])
+        Message._bulk([msg], [], [])
+
+        assert service.batch_modify_bodies == []
+        assert msg.label_ids == ['INBOX']
+
+    def test_batch_modify_sends_100_calls_per_batch(self, clock):
+        service = FakeBatchService()
+        msgs = [make_message(service, f'm{i}', ['INBOX', 'UNREAD']) for i in range(250)]
+        Message.batch_modify(msgs, label.STARRED, label.UNREAD)
+
+        assert service.batch_sizes == [100, 100, 50]
+        assert len(service.calls) == 250
+        assert all(msg.label_ids == ['INBOX', 'STARRED'] for msg in msgs)
+
+    def test_batch_modify_groups_messages_by_user(self, clock):
+        service = FakeBatchService()
+        msgs = [
+            make_message(service, 'm1', [], user_id='alice@example.com'),
+            make_message(service, 'm2', [], user_id='bob@example.com'),
+            make_message(service, 'm3', [], user_id='alice@example.com'),
+        ]
+        Message.batch_add_labels(msgs, [label.STARRED])
+
+        assert service.batch_sizes == [2, 1]
+        assert service.calls == [
+            ('modify', 'alice@example.com', 'm1'), ('modify', 'alice@example.com', 'm3'),
+            ('modify', 'bob@example.com', 'm2'),
+        ]
+
+    def test_batch_trash_retries_failed_calls(self, clock):
+        service = FakeBatchService(failing={'m2'})
+        msgs = [make_message(service, f'm{i}', []) for i in range(4)]
+        Message.batch_trash(msgs)
+
+        assert service.batch_sizes == [4]
+        assert service.calls.count(('trash', 'me', 'm2')) == 2
+        assert all(msg.label_ids == ['INBOX', 'UNREAD', 'TRASH'] for msg in msgs)
+
+    def test_add_label_by_name_looks_the_label_up_once(self, clock):
+        service = FakeBatchService(user_labels={'Invoices': 'Label_1'})
+        msgs = [make_message(service, f'm{i}', []) for i in range(3)]
+        for msg in msgs:
+            msg.add_label('invoices')
+
+        assert service.calls.count(('labels.list', 'me')) == 1
+        assert all(msg.label_ids == ['INBOX', 'UNREAD', 'Label_1'] for msg in msgs)
+
+    def test_modify_labels_refreshes_a_stale_label_id(self, clock):
+        service = FakeBatchService(user_labels={'Invoices': 'Label_1'})
+        make_message(service, 'm1', []).add_label('Invoices')
+
+        # The label is deleted and created again, under a new id
+        service.user_labels['Invoices'] = 'Label_7'
+        msg = make_message(service, 'm2', [])
+        msg.modify_labels('Invoices', [])
+
+        assert service.calls[-3:] == [('modify', 'me', 'm2'), ('labels.list', 'me'), ('modify', 'me', 'm2')]
+        assert msg.label_ids == ['INBOX', 'UNREAD', 'Label_7']
+
+    def test_modify_labels_missing_message_is_not_retried(self, clock):
+        service = FakeBatchService(missing={'m2'}, user_labels={'Invoices': 'Label_1'})
+        make_message(service, 'm1', []).add_label('Invoices')
+
+        with pytest.raises(HttpError):
+            make_message(service, 'm2', []).add_label('Invoices')
+        assert service.calls.count(('labels.list', 'me')) == 2
+        assert ('modify', 'me', 'm2') not in service.calls
+
+    def test_modify_labels_with_label_objects_is_not_retried(self, clock):
+        service = FakeBatchService()
+
+        with pytest.raises(HttpError):
+            make_message(service, 'm1', []).add_label(label.Label('Gone', 'Label_9'))
+        assert service.calls == [('modify', 'me', 'm1')]
+
+    def test_parallel_apply_creates_a_missing_label_once(self, clock, monkeypatch):
+        monkeypatch.setattr(message.AuthenticatedService, '_build_http', staticmethod(lambda credentials: None))
+        service = FakeBatchService()
+        msgs = [make_message(service, f'm{i}', []) for i in range(20)]
+        Message.parallel_apply(msgs, 'add_label', 'Receipts', max_workers=8)
+
+        assert service.calls.count(('labels.create', 'me', 'Receipts')) == 1
+        assert all(msg.label_ids == ['INBOX', 'UNREAD', 'Label_1'] for msg in msgs)
+
+
+class TestAsyncMessage(object):
+
+    def test_amodify_labels_shares_label_ids_and_refresh(self, aio):
+        service = FakeMessagesService()
+        creds = FakeCredentials()
+        msgs = [Message(service, creds, 'me', f'm{i}', 't', 'to', 'from', 'Subject', 'date', 'snippet')
+                for i in range(3)]
+
+        async def modify():
+            await asyncio.gather(*(msg.amodify_labels(['invoices', 'Receipts'], label.UNREAD) for msg in msgs))
+
+        asyncio.run(modify())
+        session = FakeSession.instances[0]
+
+        paths = [call[1] for call in session.calls]
+        assert paths.count('labels?fields=id') == 1  # Receipts is created once
+        assert sorted(paths)[-3:] == [f'messages/m{i}/modify?fields=labelIds' for i in range(3)]
+        assert all(msg.label_ids == ['INBOX', 'Label_1', 'Label_2'] for msg in msgs)
+        assert creds.refreshes == 1
+        assert all(call[2] == 'Bearer token1' for call in session.calls)
+
+    def test_arequest_retries_rate_limited_calls(self, aio):
+        msg = Message(FakeMessagesService(), FakeCredentials(), 'me', 'm1', 't', 'to', 'from', 'Subject',
+                      'date', 'snippet')
+
+        async def modify():
+            await message._aio.get_session()
+            FakeSession.instances[0].queued_statuses = [429, 503]
+            await msg.amodify_labels(label.STARRED, [])
+
+        asyncio.run(modify())
+
+        assert len(FakeSession.instances[0].calls) == 3
+        assert len(aio) == 2
+        assert 1 <= aio[0] < 2 and 2 <= aio[1] < 3
+        assert msg.label_ids == ['INBOX', 'UNREAD', 'STARRED']
+
+    def test_arequest_caps_requests_in_flight(self, aio):
+        service = FakeMessagesService()
+        creds = FakeCredentials()
+        msgs = [Message(service, creds, 'me', f'm{i}', 't', 'to', 'from', 'Subject', 'date', 'snippet')
+                for i in range(30)]
+
+        async def modify():
+            await asyncio.gather(*(msg.amodify_labels([], label.UNREAD) for msg in msgs))
+
+        asyncio.run(modify())
+
+        assert len(FakeSession.instances[0].calls) == 30
+        assert FakeSession.instances[0].max_in_flight == message._MAX_ASYNC_REQUESTS
+
+    def test_session_is_replaced_in_a_new_event_loop(self, aio):
+        msg = Message(FakeMessagesService(), FakeCredentials(), 'me', 'm1', 't', 'to', 'from', 'Subject',
+                      'date', 'snippet')
+
+        asyncio.run(msg.amodify_labels(label.STARRED, []))
+        asyncio.run(msg.amodify_labels([], label.STARRED))
+
+        first, second = FakeSession.instances
+        assert first.closed
+        assert not second.closed
+        assert len(first.calls) == 1 and len(second.calls) == 1
+
+        asyncio.run(message.close_async_session())
+        assert second.closed
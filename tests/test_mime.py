@@ -0,0 +1,134 @@
+import os
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from gmsa import mime
+
+
+def fake_puremagic(content_type):
+    'Stands in for puremagic, sniffing every file as the given content type.'
+    return SimpleNamespace(from_string=lambda head, mime: content_type, PureError=ValueError)
+
+
+class TestGuessContentType(object):
+
+    def test_guess_content_type_from_table(self):
+        assert mime._guess_content_type('Report.PDF') == 'application/pdf'
+
+    def test_guess_content_type_from_mimetypes(self):
+        assert mime._guess_content_type('notes.csv') == 'text/csv'
+
+    def test_guess_content_type_ignores_encoded_files(self):
+        assert mime._guess_content_type('backup.tar.gz') == 'application/octet-stream'
+
+    def test_guess_content_type_sniffs_unknown_extension(self, monkeypatch):
+        monkeypatch.setattr(mime, 'puremagic', fake_puremagic('application/pdf'))
+        assert mime._guess_content_type('scan', b'%PDF-1.4') == 'application/pdf'
+        assert mime._guess_content_type('scan') == 'application/octet-stream'
+
+    def test_guess_content_type_drops_sniffed_text(self, monkeypatch):
+        monkeypatch.setattr(mime, 'puremagic', fake_puremagic('text/vcard'))
+        assert mime._guess_content_type('contact', b'BEGIN:VCARD') == 'application/octet-stream'
+
+    def test_guess_content_type_without_puremagic(self, monkeypatch):
+        monkeypatch.setattr(mime, 'puremagic', None)
+        assert mime._guess_content_type('scan', b'%PDF-1.4') == 'application/octet-stream'
+
+
+class TestCIHeaderDict(object):
+
+    def test_lookup_ignores_case(self):
+        headers = mime._CIHeaderDict({'Message-ID': '<1@example.com>'})
+
+        assert headers['message-id'] == '<1@example.com>'
+        assert headers['MESSAGE-ID'] == '<1@example.com>'
+        assert list(headers) == ['Message-ID']
+        with pytest.raises(KeyError):
+            headers['subject']
+
+    def test_contains_and_get(self):
+        headers = mime._CIHeaderDict({'Subject': 'Hi'})
+
+        assert 'subject' in headers
+        assert 'to' not in headers
+        assert 1 not in headers
+        assert headers.get('SUBJECT') == 'Hi'
+        assert headers.get('to', 'nobody') == 'nobody'
+
+    def test_set_and_delete_keep_the_first_name(self):
+        headers = mime._CIHeaderDict({'Subject': 'Hi'})
+        headers['SUBJECT'] = 'Hello'
+        assert dict(headers) == {'Subject': 'Hello'}
+
+        del headers['subject']
+        assert 'Subject' not in headers
+        assert headers.get('subject') is None
+
+    def test_dict_methods_keep_lookups_case_insensitive(self):
+        headers = mime._CIHeaderDict({'Subject': 'Hi'})
+        headers.update({'TO': 'a@example.com'}, Cc='b@example.com')
+        assert headers['to'] == 'a@example.com'
+        assert headers['cc'] == 'b@example.com'
+
+        assert headers.setdefault('subject', 'Hello') == 'Hi'
+        assert headers.setdefault('Bcc', 'c@example.com') == 'c@example.com'
+        assert headers['BCC'] == 'c@example.com'
+
+        assert headers.pop('to') == 'a@example.com'
+        assert 'TO' not in headers
+        assert headers.pop('to', None) is None
+
+        copy = headers.copy()
+        assert isinstance(copy, mime._CIHeaderDict)
+        assert copy['SUBJECT'] == 'Hi'
+
+        headers.clear()
+        assert 'subject' not in headers
+        assert copy['subject'] == 'Hi'
+
+    def test_merge_operators_keep_lookups_case_insensitive(self):
+        headers = mime._CIHeaderDict({'Subject': 'Hi'})
+        headers |= {'Message-ID': '<1@example.com>'}
+        assert 'message-id' in headers
+        assert headers.get('MESSAGE-ID') == '<1@example.com>'
+
+        merged = headers | {'TO': 'a@example.com'}
+        assert isinstance(merged, mime._CIHeaderDict)
+        assert merged['to'] == 'a@example.com'
+        assert merged['subject'] == 'Hi'
+        assert 'to' not in headers
+
+        merged = {'Cc': 'b@example.com'} | headers
+        assert isinstance(merged, mime._CIHeaderDict)
+        assert merged['CC'] == 'b@example.com'
+        assert merged['message-id'] == '<1@example.com>'
+
+
+class TestMapFile(object):
+
+    def test_map_file_empty_file(self, tmp_path):
+        path = tmp_path / 'empty.txt'
+        path.write_bytes(b'')
+
+        with mime._map_file(str(path)) as data:
+            assert data == b''
+
+    def test_map_file_regular_file(self, tmp_path):
+        path = tmp_path / 'report.pdf'
+        path.write_bytes(b'%PDF-1.4 data')
+
+        with mime._map_file(str(path)) as data:
+            assert data[:] == b'%PDF-1.4 data'
+
+    @pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='needs named pipes')
+    def test_map_file_reads_non_regular_file(self, tmp_path):
+        path = tmp_path / 'pipe'
+        os.mkfifo(str(path))
+        writer = threading.Thread(target=path.write_bytes, args=(b'piped data',))
+        writer.start()
+
+        with mime._map_file(str(path)) as data:
+            assert data == b'piped data'
+        writer.join()
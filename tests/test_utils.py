@@ -17,3 +17,23 @@ class TestUtils(object):
         input_str = 'Anete Gludīte anete@example.com'
         with pytest.raises(ValueError, match=f"Input string: {input_str} is not in the correct format"):
             utils.extract_and_format_to_header(input_str)
+
+    def test_extract_and_format_to_header_with_extra_whitespace(self):
+        input_str = '  "Anete Gludte"   <anete@example.com> '
+        expected_output = 'Anete Gludte <anete@example.com>'
+        assert utils.extract_and_format_to_header(input_str) == expected_output
+
+    def test_extract_and_format_to_header_quotes_specials(self):
+        input_str = 'Doe, John J. <john.doe@example.com>'
+        expected_output = '"Doe, John J." <john.doe@example.com>'
+        assert utils.extract_and_format_to_header(input_str) == expected_output
+
+    def test_extract_and_format_to_header_with_plain_ascii_name(self):
+        input_str = 'John Doe <john.doe@example.com>'
+        expected_output = 'John Doe <john.doe@example.com>'
+        assert utils.extract_and_format_to_header(input_str) == expected_output
+
+    @pytest.mark.parametrize('input_str', ['a <b> <c@d.com>', 'Name <a@b.com>>', 'Name <a@b.com> trailing'])
+    def test_extract_and_format_to_header_rejects_trailing_text(self, input_str):
+        with pytest.raises(ValueError, match="is not in the correct format"):
+            utils.extract_and_format_to_header(input_str)